@@ -8,10 +8,13 @@
 # Author: Tony Malykh <anton.malykh@gmail.com>
 # https://github.com/mltony/nvda-indent-nav/
 
+import time
+importStartTime = time.perf_counter()
 import addonHandler
 import api
+from array import array
+import bisect
 import browseMode
-from contextlib import ExitStack
 import controlTypes
 import config
 from . constants import *
@@ -19,14 +22,17 @@ import core
 import ctypes
 import cursorManager
 import documentBase
+from . import documentIndex
 import editableText
 import functools
 import globalPluginHandler
 import gui
 from gui.settingsDialogs import SettingsPanel
+from . import hooks
 import inputCore
 import itertools
 import keyboardHandler
+from . import lineIndex
 from logHandler import log
 import math
 import nvwave
@@ -41,11 +47,11 @@ import struct
 import sys
 import textInfos
 import threading
-import time
 import tones
 import types
 import ui
 from . import utils
+from virtualBuffers import VirtualBufferTextInfo
 from virtualBuffers.gecko_ia2 import Gecko_ia2_TextInfo
 import wave
 import weakref
@@ -116,6 +122,10 @@ def initConfiguration():
         "skipChimeVolume" : "integer( default=25, min=0, max=100)",
         "skipRegex" : "string( default='(^Hide or report this$)')",
         "tableNavigateToCell" : "boolean( default=True)",
+        "useDominantFontSize" : "boolean( default=False)",
+        "selectionHistorySize" : "integer( default=1000, min=0, max=100000)",
+        "editBoxDiffUpdate" : "boolean( default=True)",
+        "rulesReloadInterval" : "integer( default=5, min=0, max=3600)",
     }
     config.conf.spec["browsernav"] = confspec
 
@@ -194,11 +204,36 @@ class SettingsDialog(SettingsPanel):
         label = _("Use bold and italic attributes for style")
         self.useBoldItalicCheckBox = sHelper.addItem(wx.CheckBox(self, label=label))
         self.useBoldItalicCheckBox.Value = getConfig("useBoldItalic")
+
+        # Translators: Checkbox that controls whether font size of a paragraph is the font size used by most of its text
+        label = _("Use font size of most of the paragraph text instead of font size at the beginning of paragraph")
+        self.useDominantFontSizeCheckBox = sHelper.addItem(wx.CheckBox(self, label=label))
+        self.useDominantFontSizeCheckBox.Value = getConfig("useDominantFontSize")
         
         label = _("Jump to the first cell of the table when T or Shift+T is pressed.")
         self.tableNavigateToCellCheckBox = sHelper.addItem(wx.CheckBox(self, label=label))
         self.tableNavigateToCellCheckBox.Value = getConfig("tableNavigateToCell")
 
+        # Translators: Label for spin control that limits the number of entries in cursor history
+        label = _("Maximum number of cursor history entries per document (0 disables cursor history):")
+        self.selectionHistorySizeEdit = sHelper.addLabeledControl(
+            label, gui.nvdaControls.SelectOnFocusSpinCtrl,
+            min=0, max=100000,
+            initial=getConfig("selectionHistorySize")
+        )
+
+        # Translators: Checkbox that controls whether only changed lines are pasted back into edit box after editing
+        label = _("When updating edit box, only replace lines that have changed")
+        self.editBoxDiffUpdateCheckBox = sHelper.addItem(wx.CheckBox(self, label=label))
+        self.editBoxDiffUpdateCheckBox.Value = getConfig("editBoxDiffUpdate")
+
+        # Translators: Label for spin control that sets how often rules file is checked for changes
+        label = _("Check browserNavRules.json for external changes every this many seconds (0 disables):")
+        self.rulesReloadIntervalEdit = sHelper.addLabeledControl(
+            label, gui.nvdaControls.SelectOnFocusSpinCtrl,
+            min=0, max=3600,
+            initial=getConfig("rulesReloadInterval")
+        )
 
 
       # skipChimeVolumeSlider
@@ -222,8 +257,14 @@ class SettingsDialog(SettingsPanel):
         config.conf["browsernav"]["useColor"] = self.useColorCheckBox.Value
         config.conf["browsernav"]["useBackgroundColor"] = self.useBackgroundColorCheckBox.Value
         config.conf["browsernav"]["useBoldItalic"] = self.useBoldItalicCheckBox.Value
+        config.conf["browsernav"]["useDominantFontSize"] = self.useDominantFontSizeCheckBox.Value
         config.conf["browsernav"]["tableNavigateToCell"] = self.tableNavigateToCellCheckBox.Value
+        config.conf["browsernav"]["selectionHistorySize"] = self.selectionHistorySizeEdit.Value
+        config.conf["browsernav"]["editBoxDiffUpdate"] = self.editBoxDiffUpdateCheckBox.Value
+        config.conf["browsernav"]["rulesReloadInterval"] = self.rulesReloadIntervalEdit.Value
         config.conf["browsernav"]["skipChimeVolume"] = self.skipChimeVolumeSlider.Value
+        hooks.update()
+        quickJump.rulesWatcher.start()
 
 
 def getMode():
@@ -308,6 +349,7 @@ kbdControlShiftHome = fromNameSmart("Control+Shift+Home")
 kbdControlShiftDown = fromNameSmart("Control+Shift+DownArrow")
 kbdShiftRight = fromNameSmart("Shift+RightArrow")
 kbdControlEnd = fromNameSmart("Control+End")
+kbdControlShiftEnd = fromNameSmart("Control+Shift+End")
 kbdBackquote = fromNameSmart("`")
 kbdDelete = fromNameSmart("Delete")
 kbdLeft = fromNameSmart("LeftArrow")
@@ -315,6 +357,29 @@ kbdRight = fromNameSmart("RightArrow")
 kbdUp = fromNameSmart("UpArrow")
 kbdDown = fromNameSmart("DownArrow")
 
+VK_END = 0x23
+GO_TO_POSITION_BATCH_SIZE = 200
+# After each batch we wait until the caret stops moving, but no longer than this.
+GO_TO_POSITION_BATCH_TIMEOUT = 0.3 # seconds
+# Delay after each batch when caret position of the edit box cannot be queried.
+GO_TO_POSITION_BATCH_DELAY = 20 # ms
+
+def computeChangedLines(oldText, newText):
+    """
+    Finds the smallest block of lines that differs between two texts.
+    Returns (firstLine, oldBlock, newBlock), where oldBlock are the lines of oldText starting at firstLine that need to be replaced with newBlock lines.
+    """
+    oldLines = oldText.split("\n")
+    newLines = newText.split("\n")
+    limit = min(len(oldLines), len(newLines))
+    prefix = 0
+    while prefix < limit and oldLines[prefix] == newLines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and oldLines[-1 - suffix] == newLines[-1 - suffix]:
+        suffix += 1
+    return prefix, oldLines[prefix:len(oldLines) - suffix], newLines[prefix:len(newLines) - suffix]
+
 allModifiers = [
     winUser.VK_LCONTROL, winUser.VK_RCONTROL,
     winUser.VK_LSHIFT, winUser.VK_RSHIFT, winUser.VK_LMENU,
@@ -324,7 +389,7 @@ allModifiers = [
 def executeAsynchronously(gen):
     """
     This function executes a generator-function in such a manner, that allows updates from the operating system to be processed during execution.
-    For an example of such generator function, please see GlobalPlugin.script_editJupyter.
+    For an example of such generator function, please see GlobalPlugin.editJupyter.
     Specifically, every time the generator function yilds a positive number,, the rest of the generator function will be executed
     from within wx.CallLater() call.
     If generator function yields a value of 0, then the rest of the generator function
@@ -415,9 +480,17 @@ class RegexSearchDialog(wx.Dialog):
         lastRegexSearch = strVal
 
 
+# Backward search starts with a window of this many characters before the cursor and doubles it until a match is found.
+BACKWARD_SEARCH_WINDOW = 1024
+
+@functools.lru_cache(maxsize=16)
+def compileSearchRegex(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
 class EditTextDialog(wx.Dialog):
     def __init__(self, parent, text, cursorLine, cursorColumn, onTextComplete):
         self.tabValue = "    "
+        self.commentValue = "# "
         # Translators: Title of calibration dialog
         title_string = _("Edit text")
         super(EditTextDialog, self).__init__(parent, title=title_string)
@@ -435,6 +508,8 @@ class EditTextDialog(wx.Dialog):
         self.textCtrl.Bind(wx.EVT_CHAR, self.onChar)
         self.Bind(wx.EVT_CHAR_HOOK, self.OnKeyUP)
         self.textCtrl.Bind(wx.EVT_TEXT_PASTE, self.onClipboardPaste)
+        self.lineIndex = lineIndex.LineIndex(self.textCtrl)
+        self.textCtrl.Bind(wx.EVT_TEXT, self.onText)
         sHelper.addItem(self.textCtrl)
         self.textCtrl.SetValue(text)
         self.SetFocus()
@@ -461,27 +536,34 @@ class EditTextDialog(wx.Dialog):
         if result == wx.ID_OK:
             self.doFind(1)
 
+    def onText(self, event):
+        self.lineIndex.invalidate()
+        event.Skip()
+
     def doFind(self, direction):
-        cursorPos = self.textCtrl.GetInsertionPoint()
-        allText = self.textCtrl.GetRange(0, -1)
-        preText = self.textCtrl.GetRange( 0, cursorPos)
-        allText = allText.replace("\r\n", "\n").replace("\r", "\n")
-        preText = preText.replace("\r\n", "\n").replace("\r", "\n")
-        r = re.compile(lastRegexSearch, re.IGNORECASE)
-        matches = list(re.finditer(r, allText))
+        text = self.lineIndex.update()
+        cursorOffset = self.lineIndex.positionToOffset(self.textCtrl.GetInsertionPoint())
+        r = compileSearchRegex(lastRegexSearch)
+        match = None
         if direction > 0:
-            matches = [m for m in matches if m.start(0) > len(preText)]
+            match = r.search(text, cursorOffset + 1)
         else:
-            matches = [m for m in matches if m.end(0) <= len(preText)]
-        if len(matches) == 0:
+            # Search in windows of growing size ending at the cursor, so that the cost depends on the distance to the match rather than on the size of text.
+            # Each window extends past the cursor as well, so that $ and \b don't match at the cursor.
+            windowSize = BACKWARD_SEARCH_WINDOW
+            while match is None:
+                start = max(0, cursorOffset - windowSize)
+                for m in r.finditer(text, start, min(len(text), cursorOffset + windowSize)):
+                    if m.end(0) > cursorOffset:
+                        break
+                    match = m
+                if start == 0:
+                    break
+                windowSize *= 2
+        if match is None:
             endOfDocument(_("No match!"))
             return
-        mindex = 0 if direction > 0 else -1
-        match = matches[mindex]
-        preMatch = allText[:match.start(0)]
-        preMatchLines = preMatch.split("\n")
-        pos = self.textCtrl.XYToPosition(len(preMatchLines[-1]), len(preMatchLines) - 1)
-        self.textCtrl.SetInsertionPoint(pos)
+        self.textCtrl.SetInsertionPoint(self.lineIndex.offsetToPosition(match.start(0)))
 
     def reindent(self, string, direction):
         if direction > 0:
@@ -490,6 +572,82 @@ class EditTextDialog(wx.Dialog):
             return string[len(self.tabValue):]
         return string.lstrip(" ")
 
+    def toggleComment(self, lines):
+        nonEmptyLines = [line for line in lines if len(line.strip()) > 0]
+        if len(nonEmptyLines) == 0:
+            return lines
+        if all(line.lstrip().startswith(self.commentValue.strip()) for line in nonEmptyLines):
+            result = []
+            for line in lines:
+                stripped = line.lstrip()
+                indent = line[:len(line) - len(stripped)]
+                if stripped.startswith(self.commentValue):
+                    stripped = stripped[len(self.commentValue):]
+                elif stripped.startswith(self.commentValue.strip()):
+                    stripped = stripped[len(self.commentValue.strip()):]
+                result.append(indent + stripped)
+            return result
+        indent = min(len(line) - len(line.lstrip()) for line in nonEmptyLines)
+        return [
+            line[:indent] + self.commentValue + line[indent:] if len(line.strip()) > 0 else line
+            for line in lines
+        ]
+
+    def getSelectedLines(self):
+        # Returns first and last line numbers of selection, not counting the last line if selection ends at its very beginning.
+        pos1, pos2 = self.textCtrl.GetSelection()
+        col1, line1 = self.lineIndex.offsetToXY(self.lineIndex.positionToOffset(pos1))
+        col2, line2 = self.lineIndex.offsetToXY(self.lineIndex.positionToOffset(pos2))
+        if col2 == 0 and line2 > line1:
+            line2 -= 1
+        return line1, line2
+
+    def replaceLines(self, line1, line2, newLines):
+        # Replaces lines line1..line2 inclusive in a single Replace call, so that undo history is preserved.
+        index = self.lineIndex
+        startPos = index.offsetToPosition(index.getLineStart(line1))
+        endPos = index.offsetToPosition(index.getLineEnd(line2))
+        self.textCtrl.Replace(startPos, endPos, "\n".join(newLines))
+        index.invalidate()
+
+    def selectLines(self, line1, line2):
+        index = self.lineIndex
+        if line2 + 1 < index.getLineCount():
+            end = index.getLineStart(line2 + 1)
+        else:
+            end = index.getLineEnd(line2)
+        self.textCtrl.SetSelection(
+            index.offsetToPosition(index.getLineStart(line1)),
+            index.offsetToPosition(end),
+        )
+
+    def applyBlockOperation(self, operation):
+        # Applies operation to all selected lines at once.
+        # operation takes a list of lines and returns a new list of lines.
+        line1, line2 = self.getSelectedLines()
+        lines = [self.lineIndex.getLine(i) for i in range(line1, line2 + 1)]
+        newLines = operation(lines)
+        if newLines == lines:
+            return
+        self.replaceLines(line1, line2, newLines)
+        self.selectLines(line1, line1 + len(newLines) - 1)
+
+    def moveLines(self, direction):
+        line1, line2 = self.getSelectedLines()
+        index = self.lineIndex
+        if direction < 0 and line1 == 0:
+            endOfDocument(_("Top of text"))
+            return
+        if direction > 0 and line2 + 1 >= index.getLineCount():
+            endOfDocument(_("Bottom of text"))
+            return
+        lines = [index.getLine(i) for i in range(line1, line2 + 1)]
+        if direction < 0:
+            self.replaceLines(line1 - 1, line2, lines + [index.getLine(line1 - 1)])
+        else:
+            self.replaceLines(line1, line2 + 1, [index.getLine(line2 + 1)] + lines)
+        self.selectLines(line1 + direction, line2 + direction)
+
     def onChar(self, event):
         control = event.ControlDown()
         shift = event.ShiftDown()
@@ -505,8 +663,7 @@ class EditTextDialog(wx.Dialog):
             if not any(modifiers):
                 # Just pure enter without any modifiers
                 # Perform Autoindent
-                curPos = self.textCtrl.GetInsertionPoint
-                lineNum = len(self.textCtrl.GetRange( 0, self.textCtrl.GetInsertionPoint() ).split("\n")) - 1
+                dummy, columnNum, lineNum = self.textCtrl.PositionToXY(self.textCtrl.GetInsertionPoint())
                 lineText = self.textCtrl.GetLineText(lineNum)
                 m = re.search("^\s*", lineText)
                 if m:
@@ -543,36 +700,13 @@ class EditTextDialog(wx.Dialog):
                     # Shift+Tab
                     curPos = self.textCtrl.GetInsertionPoint()
                     dummy, curCol, curLine = self.textCtrl.PositionToXY(curPos)
-                    beginLinePos = self.textCtrl.XYToPosition(0, curLine)
-                    allText = self.textCtrl.Value
-                    allText = allText.replace("\r\n", "\n").replace("\r", "\n")
-                    allLines = allText.split("\n")
-                    lineStr = allLines[curLine]
-                    preLine = lineStr[:curCol]
+                    preLine = self.lineIndex.getLine(curLine)[:curCol]
                     if preLine.endswith(self.tabValue):
                         newCurCol = curCol - len(self.tabValue)
-                        lineStr = lineStr[:newCurCol] + lineStr[curCol:]
-                        allLines[curLine] = lineStr
-                        allText = "\n".join(allLines)
-                        self.textCtrl.Value = allText
-                        pos = self.textCtrl.XYToPosition(newCurCol, curLine)
-                        self.textCtrl.SetInsertionPoint(pos)
-
+                        self.textCtrl.Replace(self.textCtrl.XYToPosition(newCurCol, curLine), curPos, "")
                 else:
-                    allText = self.textCtrl.Value
-                    allText = allText.replace("\r\n", "\n").replace("\r", "\n")
-                    allLines = allText.split("\n")
-                    dummy, col1, line1 = self.textCtrl.PositionToXY(pos1)
-                    dummy, col2, line2 = self.textCtrl.PositionToXY(pos2)
-                    if col2 == 0 and line2 > line1:
-                        line2 -= 1
-                    for index in range(line1, line2+1):
-                        allLines[index]  = self.reindent(allLines[index], -1 if  shift else 1)
-                    allText = "\n".join(allLines)
-                    self.textCtrl.Value = allText
-                    pos1 = self.textCtrl.XYToPosition(0, line1)
-                    pos2 = self.textCtrl.XYToPosition(0, line2 + 1)
-                    self.textCtrl.SetSelection(pos1, pos2)
+                    direction = -1 if  shift else 1
+                    self.applyBlockOperation(lambda lines: [self.reindent(line, direction) for line in lines])
         elif event.GetKeyCode() == 1:
             # Control+A
             self.textCtrl.SetSelection(-1,-1)
@@ -615,6 +749,17 @@ class EditTextDialog(wx.Dialog):
 
     def OnKeyUP(self, event):
         keyCode = event.GetKeyCode()
+        control = event.ControlDown()
+        shift = event.ShiftDown()
+        alt = event.AltDown()
+        if keyCode in [wx.WXK_UP, wx.WXK_DOWN] and alt and not control and not shift:
+            # Alt+UpArrow or Alt+DownArrow
+            self.moveLines(-1 if keyCode == wx.WXK_UP else 1)
+            return
+        if keyCode == ord("/") and control and not alt and not shift:
+            # Control+/
+            self.applyBlockOperation(self.toggleComment)
+            return
         if keyCode == wx.WXK_ESCAPE:
             self.text = self.textCtrl.GetValue()
             curPos = self.textCtrl.GetInsertionPoint()
@@ -635,40 +780,50 @@ class EditTextDialog(wx.Dialog):
 
 jupyterUpdateInProgress = False
 
+# Scroll all scrolls one paragraph out of this many, which is enough to trigger lazy loading without scrolling every single element.
+SCROLL_ALL_STEP = 10
+SCROLL_ALL_DELAY = 50 # ms
+# Upon reaching the end of document keep waiting for more content to load, doubling the delay this many times.
+SCROLL_ALL_MAX_RETRIES = 6
+scrollToAllCounter = 0
+scrollToAllInProgress = False
+
+# Gesture filter is only installed while keys are blocked, so that it doesn't slow down processing of keystrokes the rest of the time.
 originalExecuteGesture = None
 blockBeeper = Beeper()
 blockKeysUntil = 0
 def preExecuteGesture(selfself, gesture, *args, **kwargs):
-    global blockKeysUntil
-    now = time.time()
-    if now < blockKeysUntil:
+    if time.monotonic() < blockKeysUntil:
         # Block this keystroke!
         blockBeeper.fancyBeep("DG#", length=100, left=50, right=50)
         return
-    return originalExecuteGesture(selfself, gesture, *args, **kwargs)
+    executeGesture = originalExecuteGesture
+    unblockAllKeys()
+    return executeGesture(selfself, gesture, *args, **kwargs)
 
 def blockAllKeys(timeoutSeconds):
-    global blockKeysUntil
-    now = time.time()
+    global blockKeysUntil, originalExecuteGesture
+    now = time.monotonic()
     if blockKeysUntil > now:
         raise Exception("Keys are already blocked")
     blockKeysUntil =now  + timeoutSeconds
+    if originalExecuteGesture is None:
+        originalExecuteGesture = inputCore.InputManager.executeGesture
+        inputCore.InputManager.executeGesture = preExecuteGesture
     beeper.fancyBeep("CDGA", length=int(1000 * timeoutSeconds), left=5, right=5)
 
 def unblockAllKeys():
-    global blockKeysUntil
+    global blockKeysUntil, originalExecuteGesture
     blockKeysUntil = 0
+    if originalExecuteGesture is not None:
+        inputCore.InputManager.executeGesture = originalExecuteGesture
+        originalExecuteGesture = None
     beeper.stop()
 
 def getSimpleHorizontalOffset(textInfo):
-    try:
-        obj = textInfo.NVDAObjectAtStart
-        x = obj.location[0]
-        return x
-    except:
-        return None
+    return utils.getParagraphIndent(textInfo)
 
-def getFontSize(textInfo, formatting):
+def getFontSize(formatting):
     try:
         size =float( formatting["font-size"].replace("pt", ""))
         return size
@@ -687,6 +842,13 @@ def extractRoles(textInfo):
     return result
 
 def isRolePresent(textInfo, roles):
+    # Only use control index if it is already up to date, since we might be called for every paragraph.
+    index = documentIndex.getDocumentIndex(textInfo, rebuild=False)
+    controlIndex = documentIndex.getControlIndex(index, textInfo, rebuild=False) if index is not None else None
+    if controlIndex is not None:
+        paragraph = index.paragraphIndex(textInfo._startOffset)
+        if (textInfo._startOffset, textInfo._endOffset) == index.getParagraphBounds(paragraph):
+            return controlIndex.isRolePresent(paragraph, roles)
     formatConfig=config.conf['documentFormatting']
     fields = textInfo.getTextWithFields(formatConfig)
     for field in fields:
@@ -697,16 +859,53 @@ def isRolePresent(textInfo, roles):
         if role in roles:
             return True
     return False
-def getFormatting(info):
-    formatField=textInfos.FormatField()
+STYLE_KEYS = ("font-family", "color", "background-color", "bold", "italic")
+def computeFormattingSummary(info, dominant):
+    # Returns (size, style) tuple, where style contains values of STYLE_KEYS.
+    # Unless dominant font size is requested, only the first character is queried for format fields.
     formatConfig=config.conf['documentFormatting']
+    if not dominant:
+        info = info.copy()
+        info.collapse()
+        info.move(textInfos.UNIT_CHARACTER, 1, endPoint="end")
+    firstFormat = None
+    currentFormat = None
+    sizes = {}
     for field in info.getTextWithFields(formatConfig):
-        #if isinstance(field,textInfos.FieldCommand): and isinstance(field.field,textInfos.FormatField):
-        try:
-            formatField.update(field.field)
-        except:
-            pass
-    return formatField
+        if isinstance(field, textInfos.FieldCommand) and field.command == "formatChange":
+            currentFormat = field.field
+            if firstFormat is None:
+                firstFormat = currentFormat
+                if not dominant:
+                    break
+        elif isinstance(field, str) and currentFormat is not None:
+            size = getFontSize(currentFormat)
+            sizes[size] = sizes.get(size, 0) + len(field)
+    if firstFormat is None:
+        firstFormat = textInfos.FormatField()
+    if len(sizes) > 0:
+        size = max(sizes, key=sizes.get)
+    else:
+        size = getFontSize(firstFormat)
+    style = tuple(firstFormat.get(key, None) for key in STYLE_KEYS)
+    return (size, style)
+
+def getFormattingSummary(textInfo):
+    dominant = getConfig("useDominantFontSize")
+    index = documentIndex.getDocumentIndex(textInfo)
+    if index is None:
+        return computeFormattingSummary(textInfo, dominant)
+    i = index.paragraphIndex(textInfo._startOffset)
+    key = (i, dominant)
+    try:
+        return index.formatting[key]
+    except KeyError:
+        pass
+    info = textInfo.copy()
+    info._startOffset, info._endOffset = index.getParagraphBounds(i)
+    summary = computeFormattingSummary(info, dominant)
+    index.formatting[key] = summary
+    return summary
 
 def getBeepTone(textInfo):
     mode = getConfig("browserMode")
@@ -717,7 +916,7 @@ def getBeepTone(textInfo):
         tone = base_freq * (2 ** (offset/octave_pixels))
         return tone
     elif mode in [1,2]:
-        size = getFontSize(textInfo, getFormatting(textInfo))
+        size, style = getFormattingSummary(textInfo)
         # Larger fonts should map onto lower tones, so computing inverse here
         tone = 3000/size
         return tone
@@ -767,16 +966,14 @@ def sonifyTextInfoImpl(textInfo, lastTextInfo, includeCrackle):
             return
         if textInfo.compareEndPoints(lastTextInfo, 'startToStart') > 0:
             t1,t2 = t2,t1
-        if False:
-            # Old method, more precise, but seems to be causing a deadlock within NVDA with very low frequency - once every couple of days, so very difficult to debug
-            span = t1.copy()
-            span.setEndPoint(t2, 'endToEnd')
-            if span._endOffset - span._startOffset > 100000:
-                paragraphs = 50
-            else:
-                paragraphs = len(list(span.getTextInChunks(textInfos.UNIT_PARAGRAPH)))
+        # Counting paragraphs via span.getTextInChunks() is slow and seems to be causing a deadlock within NVDA with very low frequency,
+        # so instead we look up paragraph boundaries in the cached index of current document.
+        # In documents that keep changing rebuilding the index on every key press would be too slow,
+        # so we rebuild it at most every MIN_REBUILD_INTERVAL seconds and fall back to an estimate in between.
+        index = documentIndex.getDocumentIndex(t1, minRebuildInterval=documentIndex.MIN_REBUILD_INTERVAL)
+        if index is not None:
+            paragraphs = index.countParagraphs(t1._startOffset, t2._startOffset)
         else:
-            # new simplified way:
             paragraphs = (t2._endOffset - t1._startOffset) // 20
         paragraphs = max(0, paragraphs - 2)
         initialDelay = 0 if beepVolume==0 else 50
@@ -785,7 +982,6 @@ def sonifyTextInfoImpl(textInfo, lastTextInfo, includeCrackle):
 originalCaretMovementScriptHelper = None
 originalQuickNavScript = None
 originalTableScriptHelper = None
-original_set_selection = None
 def preCaretMovementScriptHelper(self, gesture,unit, direction=None,posConstant=textInfos.POSITION_SELECTION, *args, **kwargs):
     oldSelection = self.selection
     if (
@@ -835,6 +1031,7 @@ def preQuickNavScript(self,gesture, itemType, direction, errorMessage, readUnit,
                 self._set_selection(info, reason=controlTypes.OutputReason.QUICKNAV)
                 speech.speakTextInfo(info, reason=controlTypes.OutputReason.QUICKNAV)
         
+    recordJump(self, oldSelection, self.selection)
     sonifyTextInfo(self.selection, oldTextInfo=oldSelection, includeCrackle=True)
     return result
 
@@ -844,53 +1041,96 @@ def preTableScriptHelper(self, *args, **kwargs):
     sonifyTextInfo(self.selection)
     return result
 
-selectionHistory = {}
-selectionHistoryLock = threading.Lock()
-def purgeSelectionHistory():
-    # Purge expired entries
-    global selectionHistory
-    selectionHistory = {
-        k:v
-        for k,v in selectionHistory.items()
-        if k() is not None
-    }
-def pre_set_selection(self, info):
+def getSelectionHistory(document):
     try:
-        sh = self.selectionHistory
+        return document.selectionHistory
     except AttributeError:
-        sh = SelectionHistory()
-        self.selectionHistory = sh
-    sh.append(info)
-    return original_set_selection(self, info)
+        size = getConfig("selectionHistorySize")
+        sh = SelectionHistory(size) if size > 0 else None
+        document.selectionHistory = sh
+        return sh
+
+def recordJump(document, oldSelection, newSelection):
+    # Only significant jumps are recorded - QuickNav, BrowserNav commands and find, but not every caret movement.
+    sh = getSelectionHistory(document)
+    if sh is not None:
+        sh.recordJump(oldSelection, newSelection)
+quickJump.recordJump = recordJump
+
+originalDoFindText = None
+def preDoFindText(self, *args, **kwargs):
+    oldSelection = self.selection
+    result = originalDoFindText(self, *args, **kwargs)
+    recordJump(self, oldSelection, self.selection)
+    return result
 
 class SelectionHistory:
-    def __init__(self):
-        self.entries = []
+    """
+    Jump list of paragraph start offsets stored in a ring buffer.
+    Entries are addressed by logical index from 0 (oldest) to count-1 (newest).
+    ptr points to the entry of the position reached by the last jump, or by going back or forward.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = array('l', [0]) * capacity
+        self.first = 0
+        self.count = 0
         self.ptr = -1
 
-    def append(self, info):
-        if not isinstance(info, Gecko_ia2_TextInfo):
-            return
-        try:
-            del self.entries[self.ptr + 1:]
-        except IndexError:
-            pass
+    def __len__(self):
+        return self.count
+
+    def get(self, i):
+        return self.entries[(self.first + i) % self.capacity]
+
+    def getParagraphStart(self, info):
+        # Don't rebuild paragraph index in dynamic documents, it's cheaper to expand.
+        index = documentIndex.getDocumentIndex(info, rebuild=False)
+        if index is not None:
+            return index.paragraphBounds(info._startOffset)[0]
         info = info.copy()
+        info.collapse()
         info.expand(textInfos.UNIT_PARAGRAPH)
-        self.entries.append(info._startOffset)
-        self.ptr = len(self.entries)
-
-    def goBack(self, info):
-        currentInfo = info.copy()
-        currentInfo.expand(textInfos.UNIT_PARAGRAPH)
-        historicalInfo = currentInfo.copy()
-        while self.ptr > 0:
-            self.ptr -= 1
-            offset = self.entries[self.ptr]
-            historicalInfo._startOffset = historicalInfo._endOffset = offset
-            historicalInfo.expand(textInfos.UNIT_PARAGRAPH)
-            if not currentInfo.isOverlapping(historicalInfo):
-                return historicalInfo
+        return info._startOffset
+
+    def append(self, offset):
+        # Drop forward history
+        self.count = self.ptr + 1
+        if self.count > 0 and self.get(self.count - 1) == offset:
+            return
+        if self.count == self.capacity:
+            self.first = (self.first + 1) % self.capacity
+            self.count -= 1
+        self.entries[(self.first + self.count) % self.capacity] = offset
+        self.count += 1
+        self.ptr = self.count - 1
+
+    def recordJump(self, oldInfo, newInfo):
+        if not isinstance(newInfo, VirtualBufferTextInfo):
+            return
+        oldOffset = self.getParagraphStart(oldInfo)
+        newOffset = self.getParagraphStart(newInfo)
+        if oldOffset == newOffset:
+            return
+        self.append(oldOffset)
+        self.append(newOffset)
+
+    def go(self, info, direction):
+        """
+        Returns paragraph start offset of the previous or next entry that is different from current paragraph.
+        Raises IndexError if there is no such entry.
+        """
+        current = self.getParagraphStart(info)
+        if direction < 0 and self.ptr >= 0 and self.get(self.ptr) != current:
+            # The cursor has moved since the last jump, remember current position, so that we can go forward to it.
+            self.append(current)
+        ptr = self.ptr + direction
+        while 0 <= ptr < self.count:
+            offset = self.get(ptr)
+            if offset != current:
+                self.ptr = ptr
+                return offset
+            ptr += direction
         raise IndexError()
 
 
@@ -911,6 +1151,64 @@ def browserNavPopup(selfself,gesture):
         wx.CallAfter(lambda: frame.PopupMenu(menu))
     finally:
         gui.mainFrame.postPopup()
+def setReportLiveRegionDllFuncPointer(func):
+    NVDAHelper._setDllFuncPointer(NVDAHelper.localLib,"_nvdaControllerInternal_reportLiveRegion", func)
+
+def registerHooks():
+    module = sys.modules[__name__]
+    hooks.registerHook(
+        cursorManager.CursorManager, "_caretMovementScriptHelper", preCaretMovementScriptHelper,
+        module, "originalCaretMovementScriptHelper",
+        lambda: getConfig("skipEmptyParagraphs") or getConfig("skipEmptyLines") or getConfig("beepVolume") > 0,
+    )
+    hooks.registerHook(
+        browseMode.BrowseModeTreeInterceptor, "_quickNavScript", preQuickNavScript,
+        module, "originalQuickNavScript",
+        lambda: (
+            getConfig("tableNavigateToCell")
+            or getConfig("selectionHistorySize") > 0
+            or getConfig("beepVolume") > 0
+            or getConfig("crackleVolume") > 0
+        ),
+    )
+    hooks.registerHook(
+        documentBase.DocumentWithTableNavigation, "_tableMovementScriptHelper", preTableScriptHelper,
+        module, "originalTableScriptHelper",
+        lambda: getConfig("beepVolume") > 0,
+    )
+    hooks.registerHook(
+        cursorManager.CursorManager, "doFindText", preDoFindText,
+        module, "originalDoFindText",
+        lambda: getConfig("selectionHistorySize") > 0,
+    )
+    hooks.registerHook(
+        browseMode.BrowseModeDocumentTreeInterceptor, "event_gainFocus", quickJump.new_event_gainFocus,
+        quickJump, "original_event_gainFocus",
+        lambda: quickJump.anySite(lambda site:
+            site.focusMode == quickJump.FocusMode.DISABLE_FOCUS
+            or site.debugBeepMode == quickJump.DebugBeepMode.ON_FOCUS
+        ),
+    )
+    hooks.registerHook(
+        browseMode.BrowseModeTreeInterceptor, "shouldPassThrough", quickJump.newShouldPassThrough,
+        quickJump, "originalShouldPassThrough",
+        lambda: quickJump.anySite(lambda site: site.focusMode == quickJump.FocusMode.DONT_ENTER_FORM_MODE),
+    )
+    hooks.registerHook(
+        browseMode.BrowseModeDocumentTreeInterceptor, "event_treeInterceptor_gainFocus", quickJump.pre_event_treeInterceptor_gainFocus,
+        quickJump, "original_event_treeInterceptor_gainFocus",
+        lambda: quickJump.anySite(lambda site: site.autoClickOnFocus),
+    )
+    hooks.registerHook(
+        NVDAHelper, "nvdaControllerInternal_reportLiveRegion", quickJump.newReportLiveRegion,
+        quickJump, "originalReportLiveRegion",
+        lambda: quickJump.anySite(lambda site:
+            site.liveRegionMode == quickJump.LiveRegionMode.MUTE_LIVE_REGION
+            or site.debugBeepMode == quickJump.DebugBeepMode.ON_LIVE_REGION
+        ),
+        onChange=setReportLiveRegionDllFuncPointer,
+    )
+
 class GlobalPlugin(globalPluginHandler.GlobalPlugin):
     scriptCategory = _("BrowserNav")
     beeper = Beeper()
@@ -920,28 +1218,13 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
         self.createMenu()
         self.injectBrowseModeKeystrokes()
         self.lastJupyterText = ""
-        global originalExecuteGesture, originalCaretMovementScriptHelper, originalQuickNavScript, originalTableScriptHelper, original_set_selection
-        originalExecuteGesture = inputCore.InputManager.executeGesture
-        inputCore.InputManager.executeGesture = preExecuteGesture
-        originalCaretMovementScriptHelper = cursorManager.CursorManager._caretMovementScriptHelper
-        cursorManager.CursorManager._caretMovementScriptHelper = preCaretMovementScriptHelper
-        originalQuickNavScript = browseMode.BrowseModeTreeInterceptor._quickNavScript
-        browseMode.BrowseModeTreeInterceptor._quickNavScript = preQuickNavScript
-        originalTableScriptHelper = documentBase.DocumentWithTableNavigation._tableMovementScriptHelper
-        documentBase.DocumentWithTableNavigation._tableMovementScriptHelper = preTableScriptHelper
-        original_set_selection = cursorManager.CursorManager._set_selection
-        cursorManager.CursorManager._set_selection = pre_set_selection
         editableText.EditableText.script_editInBrowserNav = lambda selfself, gesture: self.script_editJupyter(gesture, selfself)
         editableText.EditableText._EditableText__gestures['kb:NVDA+E'] = 'editInBrowserNav'
-        quickJump.original_event_gainFocus = browseMode.BrowseModeDocumentTreeInterceptor.event_gainFocus
-        browseMode.BrowseModeDocumentTreeInterceptor.event_gainFocus = quickJump.new_event_gainFocus
-        quickJump.originalShouldPassThrough = browseMode.BrowseModeTreeInterceptor.shouldPassThrough
-        browseMode.BrowseModeTreeInterceptor.shouldPassThrough = quickJump.newShouldPassThrough
-        quickJump.original_event_treeInterceptor_gainFocus = browseMode.BrowseModeDocumentTreeInterceptor.event_treeInterceptor_gainFocus
-        browseMode.BrowseModeDocumentTreeInterceptor.event_treeInterceptor_gainFocus = quickJump.pre_event_treeInterceptor_gainFocus
-        quickJump.originalReportLiveRegion = NVDAHelper.nvdaControllerInternal_reportLiveRegion
-        NVDAHelper.nvdaControllerInternal_reportLiveRegion = quickJump.newReportLiveRegion
-        NVDAHelper._setDllFuncPointer(NVDAHelper.localLib,"_nvdaControllerInternal_reportLiveRegion", quickJump.newReportLiveRegion)
+        registerHooks()
+        hooks.update()
+        quickJump.preloadGlobalConfig()
+        quickJump.rulesWatcher.start()
+        config.post_configProfileSwitch.register(hooks.update)
 
         
 
@@ -953,16 +1236,11 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
     def terminate(self):
         gui.settingsDialogs.NVDASettingsDialog.categoryClasses.remove(SettingsDialog)
         gui.settingsDialogs.NVDASettingsDialog.categoryClasses.remove(quickJump.SettingsDialog)
-        cursorManager.CursorManager._caretMovementScriptHelper = originalCaretMovementScriptHelper
-        inputCore.InputManager.executeGesture = originalExecuteGesture
-        browseMode.BrowseModeTreeInterceptor._quickNavScript = originalQuickNavScript
-        documentBase.DocumentWithTableNavigation._tableMovementScriptHelper = originalTableScriptHelper
-        cursorManager.CursorManager._set_selection = original_set_selection
-        browseMode.BrowseModeDocumentTreeInterceptor.event_gainFocus = quickJump.original_event_gainFocus
-        browseMode.BrowseModeTreeInterceptor.shouldPassThrough = quickJump.originalShouldPassThrough
-        browseMode.BrowseModeDocumentTreeInterceptor.event_treeInterceptor_gainFocus = quickJump.original_event_treeInterceptor_gainFocus
-        NVDAHelper.nvdaControllerInternal_reportLiveRegion = quickJump.originalReportLiveRegion
-        NVDAHelper._setDllFuncPointer(NVDAHelper.localLib,"_nvdaControllerInternal_reportLiveRegion", quickJump.originalReportLiveRegion)
+        unblockAllKeys()
+        quickJump.rulesWatcher.stop()
+        quickJump.rulesWriter.flush()
+        config.post_configProfileSwitch.unregister(hooks.update)
+        hooks.uninstallAll()
 
 
     def script_moveToNextSibling(self, gesture, selfself):
@@ -1025,23 +1303,16 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 
     def generateBrowseModeExtractors(self, selfself):
         textInfo = selfself.selection
-        geckoMode = isinstance(textInfo, Gecko_ia2_TextInfo)
-        #geckoMode = False
-        if geckoMode:
-            document = utils.getIA2Document(textInfo)
-            documentHolder = utils.DocumentHolder(document)
         mode = getConfig("browserMode")
         if mode == 0:
             # horizontal offset
             extractFormattingFunc = lambda x: None
-            if geckoMode:
-                extractIndentFunc = lambda textInfo,x: utils.getGeckoParagraphIndent(textInfo, documentHolder)
-            else:
-                extractIndentFunc= lambda textInfo,x: getSimpleHorizontalOffset(textInfo)
+            indentProvider = utils.getIndentProvider(textInfo)
+            extractIndentFunc = lambda textInfo,x: indentProvider.getIndent(textInfo)
             extractStyleFunc = lambda x,y: None
         elif mode in [1,2]:
-            extractFormattingFunc = lambda textInfo: getFormatting(textInfo)
-            extractIndentFunc = getFontSize
+            extractFormattingFunc = getFormattingSummary
+            extractIndentFunc = lambda textInfo, summary: summary[0]
             if mode == 1:
                 # Font size only
                 extractStyleFunc = lambda textInfo, formatting: None
@@ -1054,18 +1325,21 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             extractStyleFunc
         )
 
-    def formattingToStyle(self, formatting):
-        result = []
-        if getConfig("useFontFamily"):
-            result.append(formatting.get("font-family", None))
-        if getConfig("useColor"):
-            result.append(formatting.get("color", None))
-        if getConfig("useBackgroundColor"):
-            result.append(formatting.get("background-color", None))
-        if getConfig("useBoldItalic"):
-            result.append(formatting.get("bold", None))
-            result.append(formatting.get("italic", None))
-        return tuple(result)
+    def formattingToStyle(self, summary):
+        size, style = summary
+        # Flags in the same order as STYLE_KEYS
+        flags = [
+            getConfig("useFontFamily"),
+            getConfig("useColor"),
+            getConfig("useBackgroundColor"),
+            getConfig("useBoldItalic"),
+            getConfig("useBoldItalic"),
+        ]
+        return tuple(
+            value
+            for value, flag in zip(style, flags)
+            if flag
+        )
 
     def moveInBrowser(self, increment, errorMessage, op, selfself):
         (
@@ -1074,7 +1348,8 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             extractStyleFunc
         ) = self.generateBrowseModeExtractors(selfself)
 
-        textInfo = selfself.selection.copy()
+        oldSelection = selfself.selection
+        textInfo = oldSelection.copy()
         textInfo.collapse()
         mylog(f"start: {textInfo.text}")
         textInfo.expand(textInfos.UNIT_PARAGRAPH)
@@ -1104,12 +1379,33 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                     textInfo.collapse()
                     textInfo.updateCaret()
                     selfself.selection = textInfo
+                    recordJump(selfself, oldSelection, textInfo)
                     return
             distance += 1
 
+    def jumpToParagraph(self, focus, oldSelection, textInfo, distance):
+        textInfo.updateCaret()
+        self.beeper.simpleCrackle(distance, volume=getConfig("crackleVolume"))
+        speech.speakTextInfo(textInfo, reason=REASON_CARET)
+        textInfo.collapse()
+        focus._set_selection(textInfo)
+        recordJump(focus, oldSelection, textInfo)
+
     def findByRole(self, direction, roles, errorMessage, newMethod=False):
         focus = api.getFocusObject().treeInterceptor
+        oldSelection = focus.selection
         textInfo = focus.makeTextInfo(textInfos.POSITION_CARET)
+        index = documentIndex.getDocumentIndex(textInfo, minRebuildInterval=documentIndex.MIN_REBUILD_INTERVAL)
+        controlIndex = documentIndex.getControlIndex(index, textInfo) if index is not None else None
+        if controlIndex is not None:
+            paragraph = index.paragraphIndex(textInfo._startOffset)
+            newParagraph = controlIndex.findRole(paragraph, roles, direction, atStart=not newMethod)
+            if newParagraph is None:
+                endOfDocument(errorMessage)
+                return
+            textInfo._startOffset, textInfo._endOffset = index.getParagraphBounds(newParagraph)
+            self.jumpToParagraph(focus, oldSelection, textInfo, abs(newParagraph - paragraph))
+            return
         textInfo.expand(textInfos.UNIT_PARAGRAPH)
         distance = 0
         while True:
@@ -1126,29 +1422,66 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             else:
                 testResult = isRolePresent(textInfo, roles)
             if testResult:
-                textInfo.updateCaret()
-                self.beeper.simpleCrackle(distance, volume=getConfig("crackleVolume"))
-                speech.speakTextInfo(textInfo, reason=REASON_CARET)
-                textInfo.collapse()
-                focus._set_selection(textInfo)
+                self.jumpToParagraph(focus, oldSelection, textInfo, distance)
                 return
 
     def scrollToAll(self, direction, message):
+        global scrollToAllCounter, scrollToAllInProgress
+        scrollToAllCounter += 1
+        if scrollToAllInProgress:
+            scrollToAllInProgress = False
+            ui.message(_("Scrolling stopped."))
+            return
         ui.message(message)
         focus = api.getFocusObject().treeInterceptor
-        textInfo = focus.makeTextInfo(textInfos.POSITION_CARET)
-        textInfo.expand(textInfos.UNIT_PARAGRAPH)
-        textInfo.collapse()
-        distance = 0
-        while True:
-            distance += 1
-            #textInfo.collapse()
-            result = textInfo.move(textInfos.UNIT_PARAGRAPH, direction)
-            if result == 0:
-                ui.message(_("Done."))
-                return
-            #textInfo.expand(textInfos.UNIT_PARAGRAPH)
-            textInfo.NVDAObjectAtStart.scrollIntoView()
+        scrollToAllInProgress = True
+        utils.executeAsynchronously(self.asyncScrollToAll(focus, direction, scrollToAllCounter))
+
+    def asyncScrollToAll(self, focus, direction, counter):
+        # Generator function that scrolls every SCROLL_ALL_STEP-th paragraph into view.
+        # Once we reach the end of document, it keeps waiting for lazy-loaded content until the document stops growing.
+        global scrollToAllInProgress
+        try:
+            textInfo = focus.makeTextInfo(textInfos.POSITION_CARET)
+            textInfo.collapse()
+            index = documentIndex.getDocumentIndex(textInfo)
+            retries = 0
+            while True:
+                if scrollToAllCounter != counter:
+                    return
+                try:
+                    if api.getFocusObject().treeInterceptor != focus:
+                        return
+                except AttributeError:
+                    return
+                if index is not None:
+                    # Index is rebuilt whenever more content is loaded.
+                    # Paragraph numbers might shift as a result, so we keep track of current position by offset.
+                    index = documentIndex.getDocumentIndex(textInfo)
+                if index is not None:
+                    i = index.paragraphIndex(textInfo._startOffset)
+                    j = max(0, min(len(index) - 1, i + direction * SCROLL_ALL_STEP))
+                    moved = i != j
+                    if moved:
+                        textInfo._startOffset, textInfo._endOffset = index.getParagraphBounds(j)
+                else:
+                    moved = textInfo.move(textInfos.UNIT_PARAGRAPH, direction * SCROLL_ALL_STEP) != 0
+                if moved:
+                    obj = textInfo.NVDAObjectAtStart
+                    if obj is not None:
+                        obj.scrollIntoView()
+                    self.beeper.simpleCrackle(1, volume=getConfig("crackleVolume"))
+                    retries = 0
+                    yield SCROLL_ALL_DELAY
+                else:
+                    if retries >= SCROLL_ALL_MAX_RETRIES:
+                        ui.message(_("Done."))
+                        return
+                    retries += 1
+                    yield SCROLL_ALL_DELAY * (2 ** retries)
+        finally:
+            if scrollToAllCounter == counter:
+                scrollToAllInProgress = False
 
     #blacklistKeys = {"_startOfNode", "_endOfNode"}
     whitelistKeys = "color,font-family,font-size,bold,italic,strikethrough,underline".split(",")
@@ -1174,10 +1507,71 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 
         return True
 
+    def getFormatRuns(self, index, textInfo, i):
+        # Returns run-length encoded formatting of i-th paragraph, computing it on the first request.
+        try:
+            return index.formatRuns[i]
+        except KeyError:
+            pass
+        formatConfig=config.conf['documentFormatting']
+        info = textInfo.copy()
+        info._startOffset, info._endOffset = index.getParagraphBounds(i)
+        offset = info._startOffset
+        starts = array('l')
+        ids = array('l')
+        formatId = index.internFormat(tuple(None for key in self.whitelistKeys))
+        for field in info.getTextWithFields(formatConfig):
+            if isinstance(field, textInfos.FieldCommand) and field.command == "formatChange":
+                formatId = index.internFormat(tuple(field.field.get(key, None) for key in self.whitelistKeys))
+            elif isinstance(field, str) and len(field) > 0:
+                if len(ids) == 0 or ids[-1] != formatId:
+                    starts.append(offset)
+                    ids.append(formatId)
+                offset += documentIndex.getOffsetLength(field)
+        index.formatRuns[i] = (starts, ids)
+        return starts, ids
+
+    def findFormatChangeInIndex(self, selfself, index, caretInfo, direction, errorMessage):
+        oldSelection = selfself.selection
+        offset = caretInfo._startOffset
+        i = index.paragraphIndex(offset)
+        starts, ids = self.getFormatRuns(index, caretInfo, i)
+        if len(ids) == 0:
+            raise Exception("No formatting information available at the cursor!")
+        originalId = ids[max(0, bisect.bisect_right(starts, offset) - 1)]
+        firstParagraph = True
+        while True:
+            end = index.getParagraphBounds(i)[1]
+            runs = list(zip(starts, list(starts[1:]) + [end], ids))
+            if direction < 0:
+                runs.reverse()
+            for runStart, runEnd, formatId in runs:
+                if formatId == originalId:
+                    continue
+                # Run containing the caret has original formatting, so differing runs lie entirely on one side of the caret.
+                if firstParagraph and (runEnd <= offset if direction > 0 else runStart >= offset):
+                    continue
+                caretInfo._startOffset, caretInfo._endOffset = runStart, runEnd
+                caretInfo.updateCaret()
+                selfself.selection = caretInfo
+                recordJump(selfself, oldSelection, caretInfo)
+                speech.speakTextInfo(caretInfo, reason=REASON_CARET)
+                return
+            firstParagraph = False
+            i += direction
+            if not (0 <= i < len(index)):
+                endOfDocument(errorMessage)
+                return
+            starts, ids = self.getFormatRuns(index, caretInfo, i)
+
     def findFormatChange(self, selfself, direction, errorMessage):
         mylog(f"findFormatChange direction={direction}")
+        oldSelection = selfself.selection
         caretInfo = selfself.makeTextInfo(textInfos.POSITION_CARET)
         caretInfo.collapse()
+        index = documentIndex.getDocumentIndex(caretInfo)
+        if index is not None:
+            return self.findFormatChangeInIndex(selfself, index, caretInfo, direction, errorMessage)
         paragraphInfo = caretInfo.copy()
         paragraphInfo.expand(textInfos.UNIT_PARAGRAPH)
         textInfo = paragraphInfo.copy()
@@ -1282,6 +1676,7 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                     caretInfo.move(textInfos.UNIT_CHARACTER, direction * (endAdjustment - beginAdjustment), endPoint="end" if direction > 0 else "start")
                     caretInfo.updateCaret()
                     selfself.selection = caretInfo
+                    recordJump(selfself, oldSelection, caretInfo)
                     speech.speakTextInfo(caretInfo, reason=REASON_CARET)
                     return
             if True:
@@ -1315,7 +1710,19 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                     return field.field.get('uniqueID', 0)
             return None
         focus = api.getFocusObject().treeInterceptor
+        oldSelection = focus.selection
         textInfo = focus.makeTextInfo(textInfos.POSITION_CARET)
+        index = documentIndex.getDocumentIndex(textInfo, minRebuildInterval=documentIndex.MIN_REBUILD_INTERVAL)
+        controlIndex = documentIndex.getControlIndex(index, textInfo) if index is not None else None
+        if controlIndex is not None:
+            paragraph = index.paragraphIndex(textInfo._startOffset)
+            newParagraph = controlIndex.findNext(paragraph, role, direction)
+            if newParagraph is None:
+                endOfDocument(errorMessage)
+                return
+            textInfo._startOffset, textInfo._endOffset = index.getParagraphBounds(newParagraph)
+            self.jumpToParagraph(focus, oldSelection, textInfo, abs(newParagraph - paragraph))
+            return
         textInfo.expand(textInfos.UNIT_PARAGRAPH)
         originalId = getUniqueId(textInfo)
         distance = 0
@@ -1329,11 +1736,7 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             textInfo.expand(textInfos.UNIT_PARAGRAPH)
             newId = getUniqueId(textInfo)
             if newId is not None and (newId != originalId):
-                textInfo.updateCaret()
-                self.beeper.simpleCrackle(distance, volume=getConfig("crackleVolume"))
-                speech.speakTextInfo(textInfo, reason=REASON_CARET)
-                textInfo.collapse()
-                focus._set_selection(textInfo)
+                self.jumpToParagraph(focus, oldSelection, textInfo, distance)
                 return
 
     def script_editJupyter(self, gesture, selfself):
@@ -1342,67 +1745,80 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             ui.message_("Jupyter cell update in progress!")
             self.beeper.fancyBeep("AF#", length=100, left=20, right=20)
             return
-        fg=winUser.getForegroundWindow()
-        if isinstance(selfself, editableText.EditableText):
-            obj = selfself
-        elif not config.conf["virtualBuffers"]["autoFocusFocusableElements"]:
-            # We need to temporarily disable NVDA setting "Browse Mode > Automatic focus mode for focus changes"
-            # Since we are going to focus current editable and don't want to enter focus mode.
-            originalAutoPassThrough = config.conf["virtualBuffers"]["autoPassThroughOnFocusChange"]
-            config.conf["virtualBuffers"]["autoPassThroughOnFocusChange"] = False
-            with ExitStack() as stack:
-                # return original value upon exiting this function
-                # Actually sometimes focus events come in delayed, so we need to wait still a little longer, hence delaying for 1 second after exiting.
+        jupyterUpdateInProgress = True
+        utils.executeAsynchronously(self.editJupyter(selfself))
+
+    def editJupyter(self, selfself):
+        # Generator function that goes through the following stages:
+        # focus edit box, copy its text out, show edit text dialog.
+        # It yields while waiting for the browser, so that NVDA stays responsive.
+        global jupyterUpdateInProgress
+        try:
+            fg=winUser.getForegroundWindow()
+          # Stage 1: make sure edit box is focused
+            if isinstance(selfself, editableText.EditableText):
+                obj = selfself
+            elif not config.conf["virtualBuffers"]["autoFocusFocusableElements"]:
+                # We need to temporarily disable NVDA setting "Browse Mode > Automatic focus mode for focus changes"
+                # Since we are going to focus current editable and don't want to enter focus mode.
+                originalAutoPassThrough = config.conf["virtualBuffers"]["autoPassThroughOnFocusChange"]
+                config.conf["virtualBuffers"]["autoPassThroughOnFocusChange"] = False
                 def restoreAutoPassThrough():
                     config.conf["virtualBuffers"]["autoPassThroughOnFocusChange"] =             originalAutoPassThrough
-                def restoreAutoPassThroughDelayed():
+                try:
+                    selfself._focusLastFocusableObject()
+                    try:
+                        obj = selfself._lastFocusableObj
+                    except AttributeError:
+                        obj = selfself.currentFocusableNVDAObject
+                    timeout = time.time() + 2
+                    # Wait until the element we'd like to focus is actually focused
+                    while True:
+                        if time.time() > timeout:
+                            raise EditBoxUpdateError(_("Timeout while trying to focus current edit box."))
+                        focus = api.getFocusObject()
+                        if obj.IA2UniqueID == focus.IA2UniqueID:
+                            break
+                        yield 10
+                finally:
+                    # Sometimes focus events come in delayed, so we need to wait still a little longer, hence delaying for 1 second.
                     core.callLater(1000, restoreAutoPassThrough)
-                stack.callback(restoreAutoPassThroughDelayed)
-
-            selfself._focusLastFocusableObject()
+            else:
+                obj=selfself.currentNVDAObject
+            if obj.role != ROLE_EDITABLETEXT:
+                ui.message(_("Not editable"))
+                return
+            uniqueID = obj.IA2UniqueID
+          # Stage 2: copy text and text before the cursor out of edit box
+            self.startInjectingKeystrokes()
             try:
-                obj = selfself._lastFocusableObj
-            except AttributeError:
-                obj = selfself.currentFocusableNVDAObject
-            timeout = time.time() + 2
-            # Wait until the element we'd like to focus is actually focused
-            while True:
-                if time.time() > timeout:
-                    raise EditBoxUpdateError(_("Timeout while trying to focus current edit box."))
-                focus = api.getFocusObject()
-                if obj.IA2UniqueID == focus.IA2UniqueID:
-                    break
-                time.sleep(10/1000) # sleep a bit to make sure that this object has properly focused
-                api.processPendingEvents(processEventQueue=True)
-        else:
-            obj=selfself.currentNVDAObject
-        if obj.role != ROLE_EDITABLETEXT:
-            ui.message(_("Not editable"))
+                kbdLeft.send()
+                kbdRight.send()
+                kbdControlShiftHome.send()
+                preText = yield from self.getSelection()
+                kbdControlA.send()
+                text = yield from self.getSelection()
+                kbdControlHome.send()
+            except NoSelectionError as e:
+                core.callLater(
+                    100,
+                    speech.speak,
+                    [_("Cannot copy text out of edit box. Please make sure edit box is not empty and not read-only!")],
+                )
+                return
+            finally:
+                self.endInjectingKeystrokes()
+        except EditBoxUpdateError as e:
+            ui.message(str(e))
             return
-        uniqueID = obj.IA2UniqueID
-        self.startInjectingKeystrokes()
-        try:
-            kbdLeft.send()
-            kbdRight.send()
-            kbdControlShiftHome.send()
-            preText = self.getSelection()
-            kbdControlA.send()
-            text = self.getSelection()
-            kbdControlHome.send()
-        except NoSelectionError as e:
-            self.endInjectingKeystrokes()
-            core.callLater(
-                100,
-                speech.speak,
-                [_("Cannot copy text out of edit box. Please make sure edit box is not empty and not read-only!")],
-            )
-            raise e
         finally:
-            self.endInjectingKeystrokes()
+            jupyterUpdateInProgress = False
+      # Stage 3: show edit text dialog
         if (len(text) == 0) or len(preText) == 0:
             ui.message("Failed to copy text from semi-accessible edit-box. Please make sure edit box is not empty.")
             return
         preLines = preText.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        originalText = text.replace("\r\n", "\n").replace("\r", "\n")
         cursorLine = len(preLines) - 1
         cursorColumn = len(preLines[-1])
         def getFocusObjectVerified():
@@ -1429,16 +1845,160 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                 result.append(input)
             return result
 
-        def goToPosition(lineNum, columnNum):
-            # This function is too slow for line numbers > 1000.
-            # This is probably due to slow performance of Python's marshalling complex arguments to native Windows DLL
-            # This is a good candidate to rewrite in a native code and supply in a tiny DLL file
+        def getCaretOffset():
+            return api.getFocusObject().makeTextInfo(textInfos.POSITION_CARET)._startOffset
+
+        def waitForCaret(oldOffset):
+            # Generator function that waits until the browser has processed keystrokes sent so far:
+            # first until the caret starts moving and then until it stops.
+            deadline = time.monotonic() + GO_TO_POSITION_BATCH_TIMEOUT
+            lastOffset = oldOffset
+            moved = False
+            while time.monotonic() < deadline:
+                yield 1
+                try:
+                    offset = getCaretOffset()
+                except Exception:
+                    yield GO_TO_POSITION_BATCH_DELAY
+                    return
+                if offset != lastOffset:
+                    moved = True
+                    lastOffset = offset
+                elif moved:
+                    return
+
+        def sendVkInBatches(vk, count):
+            # Sending thousands of keystrokes in a single SendInput call overflows the input queue of the browser and is slow to marshal.
+            # So we send them in fixed-size batches, and before sending the next batch we wait for the caret to settle.
+            batch = makeVkInput(vk)
+            while count > 0:
+                n = min(count, GO_TO_POSITION_BATCH_SIZE)
+                try:
+                    oldOffset = getCaretOffset()
+                except Exception:
+                    oldOffset = None
+                with keyboardHandler.ignoreInjection():
+                    winUser.SendInput(batch * n)
+                count -= n
+                yield from waitForCaret(oldOffset)
+
+        def goToPosition(lineNum, columnNum, text):
+            # Generator function that moves the cursor to given position by sending arrow keystrokes.
+            # We start either from the beginning or from the end of edit box, whichever is closer.
+            t0 = time.perf_counter()
+            lines = text.split("\n")
+            lineNum = min(lineNum, len(lines) - 1)
+            linesFromEnd = len(lines) - 1 - lineNum
             mylog(f"Pressing arrows to go to line={lineNum}, col={columnNum}")
-            inputs = []
-            inputs.extend(makeVkInput(winUser.VK_DOWN) * lineNum)
-            inputs.extend(makeVkInput(winUser.VK_RIGHT) * columnNum)
-            with keyboardHandler.ignoreInjection():
-                winUser.SendInput(inputs)
+            if linesFromEnd < lineNum:
+                kbdControlEnd.send()
+                yield from sendVkInBatches(winUser.VK_UP, linesFromEnd)
+                yield from sendVkInBatches(VK_END, 1)
+                yield from sendVkInBatches(winUser.VK_LEFT, max(0, len(lines[lineNum]) - columnNum))
+            else:
+                kbdControlHome.send()
+                yield from sendVkInBatches(winUser.VK_DOWN, lineNum)
+                yield from sendVkInBatches(winUser.VK_RIGHT, columnNum)
+            mylog(f"goToPosition line={lineNum} took {time.perf_counter() - t0:.3f}s")
+
+        def getOffset(lineNum, columnNum, text):
+            lines = text.split("\n")
+            lineNum = min(lineNum, len(lines) - 1)
+            return sum(len(line) + 1 for line in lines[:lineNum]) + min(columnNum, len(lines[lineNum]))
+
+        def readCursorOffset():
+            # Generator function that returns cursor offset in the text by copying everything before the cursor.
+            kbdControlShiftHome.send()
+            try:
+                preText = yield from self.getSelection()
+            except NoSelectionError:
+                # Nothing is selected, so cursor must be at the very beginning.
+                return 0
+            # Collapse selection back to the cursor
+            kbdRight.send()
+            return len(preText.replace("\r\n", "\n").replace("\r", "\n"))
+
+        def goToPositionVerified(lineNum, columnNum, text):
+            # Generator function that moves the cursor and then reads it back.
+            # Keystrokes might be dropped, and Up and Down arrows move by visual lines in edit boxes that wrap long lines.
+            # So if the cursor has ended up elsewhere, we use the text before the cursor as an anchor
+            # and move by characters from there, since Left and Right arrows move exactly one character regardless of wrapping.
+            targetOffset = getOffset(lineNum, columnNum, text)
+            if targetOffset == 0:
+                kbdControlHome.send()
+                return
+            yield from goToPosition(lineNum, columnNum, text)
+            for attempt in range(2):
+                offset = yield from readCursorOffset()
+                if offset == targetOffset:
+                    return
+                mylog(f"Cursor is at {offset} instead of {targetOffset}, correcting")
+                if offset < targetOffset:
+                    yield from sendVkInBatches(winUser.VK_RIGHT, targetOffset - offset)
+                else:
+                    yield from sendVkInBatches(winUser.VK_LEFT, offset - targetOffset)
+            offset = yield from readCursorOffset()
+            if offset != targetOffset:
+                log.warning(f"BrowserNav failed to position cursor in edit box: expected offset {targetOffset}, actual {offset}")
+                ui.message(_("Failed to restore cursor position in edit box."))
+
+        def replaceAll(newText):
+            self.copyToClip(newText)
+            kbdControlA.send()
+            kbdControlV.send()
+
+        def replaceChangedLines(newText):
+            # Generator function that selects only the block of lines that differs from the original text and replaces it.
+            # This is much faster for large edit boxes and preserves undo history and syntax highlighting of the web app.
+            originalLines = originalText.split("\n")
+            firstLine, oldBlock, newBlock = computeChangedLines(originalText, newText)
+            mylog(f"Replacing lines {firstLine}..{firstLine + len(oldBlock)} with {len(newBlock)} lines")
+            if len(oldBlock) > len(originalLines) // 2:
+                # Selecting that many lines with arrows is slower than pasting everything
+                replaceAll(newText)
+                return
+            if len(oldBlock) == 0 and firstLine < len(originalLines):
+                # Lines have been inserted: also replace the following line, so that we have a selection to verify.
+                oldBlock = [originalLines[firstLine]]
+                newBlock = newBlock + oldBlock
+            if firstLine + len(oldBlock) < len(originalLines):
+                # Changed block is followed by unchanged lines: select whole lines together with trailing line breaks
+                yield from goToPosition(firstLine, 0, originalText)
+                yield from sendVkInBatches([winUser.VK_SHIFT, winUser.VK_DOWN], len(oldBlock))
+                expectedSelection = "".join(line + "\n" for line in oldBlock)
+                replacement = "".join(line + "\n" for line in newBlock)
+            elif len(oldBlock) == 0:
+                # Lines have been appended at the end
+                kbdControlEnd.send()
+                expectedSelection = None
+                replacement = "\n" + "\n".join(newBlock)
+            elif len(newBlock) > 0 or firstLine == 0:
+                yield from goToPosition(firstLine, 0, originalText)
+                kbdControlShiftEnd.send()
+                expectedSelection = "\n".join(oldBlock)
+                replacement = "\n".join(newBlock)
+            else:
+                # Lines have been deleted at the end, so we also need to delete preceding line break
+                yield from goToPosition(firstLine - 1, len(originalLines[firstLine - 1]), originalText)
+                kbdControlShiftEnd.send()
+                expectedSelection = "\n" + "\n".join(oldBlock)
+                replacement = ""
+            if expectedSelection is not None:
+                # Up and Down arrows move by visual lines in edit boxes that wrap long lines,
+                # so we make sure we've selected the right lines before overwriting them.
+                try:
+                    selection = yield from self.getSelection()
+                except NoSelectionError:
+                    selection = None
+                if selection is None or selection.replace("\r\n", "\n").replace("\r", "\n") != expectedSelection:
+                    mylog("Selected text doesn't match changed lines, replacing all text instead")
+                    replaceAll(newText)
+                    return
+            if len(replacement) == 0:
+                kbdDelete.send()
+            else:
+                self.copyToClip(replacement)
+                kbdControlV.send()
 
         def updateText(result, text, hasChanged, cursorLine, cursorColumn, keystroke):
             mylog(f"hasChanged={hasChanged}")
@@ -1501,30 +2061,28 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                 self.startInjectingKeystrokes()
                 try:
                     shortTextMode = len(text) < 5
-                  # Step 3.1. Select all and paste
+                  # Step 3.1. Select changed lines or all text and paste
                     if hasChanged:
-                        self.copyToClip(text)
-                        kbdControlA.send()
-                        kbdControlV.send()
+                        if getConfig("editBoxDiffUpdate"):
+                            yield from replaceChangedLines(text)
+                        else:
+                            replaceAll(text)
                   # Step 3.2. Select first character and copy to clip and wait to assure that edit box has processed the previous paste
                     if  hasChanged and not shortTextMode:
                         kbdControlHome.send()
                         kbdShiftRight.send()
+                        clipboardWatcher = utils.ClipboardWatcher()
                         kbdControlC.send()
                   # Step 3.3: Position cursor to synchronize with edit text window cursor
-                    kbdControlHome.send()
-                    goToPosition(cursorLine, cursorColumn)
+                    yield from goToPositionVerified(cursorLine, cursorColumn, text)
                   # Step 3.4: Wait for clipbord to be updated to make sure we can flush clipboard
                     if  hasChanged and not shortTextMode:
                         while True:
                             yield 1
                             if time.time() > timeout:
                                 raise EditBoxUpdateError(_("Timed out during single-character control+C stage"))
-                            try:
-                                newText = api.getClipData()
-                            except PermissionError:
-                                continue
-                            if text != newText:
+                            if clipboardWatcher.hasChanged():
+                                # Only edit box can update clipboard after our control+C
                                 break
                     else:
                         # For very short texts just sleep a bit longer
@@ -1610,7 +2168,9 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
         raise Exception(lastException)
 
     def getSelection(self):
+        # Generator function, returns text copied out of the application.
         self.copyToClip(controlCharacter)
+        clipboardWatcher = utils.ClipboardWatcher()
         t0 = time.time()
         timeout = t0+3
         lastControlCTimestamp = 0
@@ -1620,15 +2180,16 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                 kbdControlC.send()
             if time.time() > timeout:
                 raise NoSelectionError("Time out while trying to copy data out of application.")
-
-            try:
-                data = api.getClipData()
-                if data != controlCharacter:
-                    return data
-            except PermissionError:
-                pass
-            wx.Yield()
-            time.sleep(10/1000)
+            # Only open the clipboard once it has actually been updated.
+            if clipboardWatcher.hasChanged():
+                clipboardWatcher.reset()
+                try:
+                    data = api.getClipData()
+                    if data != controlCharacter:
+                        return data
+                except PermissionError:
+                    clipboardWatcher.markChanged()
+            yield 10
 
     def popupEditTextDialog(self, text, cursorLine, cursorColumn, onTextComplete):
         gui.mainFrame.prePopup()
@@ -1638,24 +2199,33 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 
     def script_toggleOption(self, gesture, selfself, option, messages):
         setConfig(option, not getConfig(option))
+        hooks.update()
         message = messages[int(getConfig(option))]
         ui.message(message)
 
     def script_goBack(self, gesture, selfself):
-        try:
-            sh = selfself.selectionHistory
-        except AttributeError:
+        self.goInSelectionHistory(selfself, -1, _("Cannot go back any more"))
+
+    def script_goForward(self, gesture, selfself):
+        self.goInSelectionHistory(selfself, 1, _("Cannot go forward any more"))
+
+    def goInSelectionHistory(self, selfself, direction, errorMessage):
+        sh = getattr(selfself, "selectionHistory", None)
+        if sh is None:
             endOfDocument(_("No cursor history available"))
             return
         try:
-            info = sh.goBack(selfself.selection)
+            offset = sh.go(selfself.selection, direction)
         except  IndexError:
-            endOfDocument(_("Cannot go back any more"))
+            endOfDocument(errorMessage)
             return
+        info = selfself.makeTextInfo(textInfos.POSITION_CARET)
+        info._startOffset = info._endOffset = offset
         expandInfo = info.copy()
         expandInfo.expand(textInfos.UNIT_PARAGRAPH)
         speech.speakTextInfo(expandInfo, unit=textInfos.UNIT_PARAGRAPH, reason=REASON_CARET)
-        original_set_selection(selfself, info)
+        expandInfo.collapse()
+        selfself.selection = expandInfo
 
     def injectBrowseModeKeystroke(self, keystrokes, funcName, script=None, doc=None):
         gp = self
@@ -1981,7 +2551,15 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
                 gesture,
                 selfself,
             ),
-            doc=_("Experimental: go back to the previous location of cursor in current document"))
+            doc=_("Go back to the previous location of cursor in current document"))
+        self.injectBrowseModeKeystroke(
+            "kb:NVDA+Shift+RightArrow",
+            "goForward",
+            script=lambda selfself, gesture: self.script_goForward(
+                gesture,
+                selfself,
+            ),
+            doc=_("Go forward to the next location of cursor in current document"))
         self.injectBrowseModeKeystroke(
             "kb:NVDA+J",
             "browserNavPopup",
@@ -1991,6 +2569,10 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
             ),
             doc=_("Show BrowserNav popup menu."))
 
-
-
-
+# Add-on is imported during NVDA startup, so we keep an eye on how long it takes.
+IMPORT_TIME_BUDGET = 0.3 # seconds
+importTime = time.perf_counter() - importStartTime
+if importTime > IMPORT_TIME_BUDGET:
+    log.warning(f"BrowserNav took {importTime:.3f} seconds to import, which is over the budget of {IMPORT_TIME_BUDGET} seconds")
+else:
+    log.debug(f"BrowserNav took {importTime:.3f} seconds to import")
@@ -34,13 +34,20 @@ class Beeper:
     MAX_BEEP_COUNT = 40 # Corresponds to about 500 paragraphs with the log formula
 
     def __init__(self):
-        self.player = nvwave.WavePlayer(
-            channels=2,
-            samplesPerSec=int(tones.SAMPLE_RATE),
-            bitsPerSample=16,
-            outputDevice=config.conf["speech"]["outputDevice"],
-            wantDucking=False
-        )
+        self._player = None
+
+    @property
+    def player(self):
+        # Audio device is only opened when the first sound is played.
+        if self._player is None:
+            self._player = nvwave.WavePlayer(
+                channels=2,
+                samplesPerSec=int(tones.SAMPLE_RATE),
+                bitsPerSample=16,
+                outputDevice=config.conf["speech"]["outputDevice"],
+                wantDucking=False
+            )
+        return self._player
 
 
 
@@ -89,25 +96,8 @@ class Beeper:
         return result
 
     def fancyBeep(self, chord, length, left=10, right=10):
-        beepLen = length
-        freqs = self.getChordFrequencies(chord)
-        intSize = 8 # bytes
-        bufSize = max([NVDAHelper.generateBeep(None,freq, beepLen, right, left) for freq in freqs])
-        if bufSize % intSize != 0:
-            bufSize += intSize
-            bufSize -= (bufSize % intSize)
+        packed = renderChord(tuple(self.getChordFrequencies(chord)), length, left, right)
         self.player.stop()
-        bbs = []
-        result = [0] * (bufSize//intSize)
-        for freq in freqs:
-            buf = ctypes.create_string_buffer(bufSize)
-            NVDAHelper.generateBeep(buf, freq, beepLen, right, left)
-            bytes = bytearray(buf)
-            unpacked = struct.unpack("<%dQ" % (bufSize // intSize), bytes)
-            result = map(operator.add, result, unpacked)
-        maxInt = 1 << (8 * intSize)
-        result = map(lambda x : x %maxInt, result)
-        packed = struct.pack("<%dQ" % (bufSize // intSize), *result)
         self.player.feed(packed)
 
     def uniformSample(self, a, m):
@@ -120,8 +110,28 @@ class Beeper:
             result.append(a[i  // m])
         return result
     def stop(self):
-        self.player.stop()
-
+        if self._player is not None:
+            self._player.stop()
+
+
+@functools.lru_cache(maxsize=64)
+def renderChord(freqs, beepLen, left, right):
+    # Synthesizing a chord is expensive, and the same few chords are played over and over, so we cache rendered buffers.
+    intSize = 8 # bytes
+    bufSize = max([NVDAHelper.generateBeep(None,freq, beepLen, right, left) for freq in freqs])
+    if bufSize % intSize != 0:
+        bufSize += intSize
+        bufSize -= (bufSize % intSize)
+    result = [0] * (bufSize//intSize)
+    for freq in freqs:
+        buf = ctypes.create_string_buffer(bufSize)
+        NVDAHelper.generateBeep(buf, freq, beepLen, right, left)
+        bytes = bytearray(buf)
+        unpacked = struct.unpack("<%dQ" % (bufSize // intSize), bytes)
+        result = map(operator.add, result, unpacked)
+    maxInt = 1 << (8 * intSize)
+    result = map(lambda x : x %maxInt, result)
+    return struct.pack("<%dQ" % (bufSize // intSize), *result)
 
 beeper = Beeper()
 
@@ -0,0 +1,32 @@
+#A part of the BrowserNav addon for NVDA
+#Copyright (C) 2017-2021 Tony Malykh
+#This file is covered by the GNU General Public License.
+#See the file LICENSE  for more details.
+
+# This module doesn't depend on NVDA, so that it can be tested standalone.
+
+import ctypes
+
+def getClipboardSequenceNumber():
+    # Windows API is looked up on first call, so that this module can be imported on other platforms.
+    return ctypes.windll.user32.GetClipboardSequenceNumber()
+
+class ClipboardWatcher:
+    """
+    Detects clipboard updates by checking clipboard sequence number.
+    Windows increments this number on every clipboard change and it can be queried without opening the clipboard,
+    so polling it is cheap and doesn't interfere with the application that is trying to write to the clipboard.
+    """
+    def __init__(self, getSequenceNumber=getClipboardSequenceNumber):
+        self.getSequenceNumber = getSequenceNumber
+        self.reset()
+
+    def reset(self):
+        self.sequenceNumber = self.getSequenceNumber()
+
+    def hasChanged(self):
+        return self.getSequenceNumber() != self.sequenceNumber
+
+    def markChanged(self):
+        # Makes hasChanged() return True until next reset(), e.g. when the clipboard was busy and we need to read it again.
+        self.sequenceNumber = None
@@ -0,0 +1,306 @@
+#A part of the BrowserNav addon for NVDA
+#Copyright (C) 2017-2021 Tony Malykh
+#This file is covered by the GNU General Public License.
+#See the file LICENSE  for more details.
+
+# Per-document caches that allow BrowserNav to answer questions about the document without walking it paragraph by paragraph.
+# In virtual buffers paragraphs are delimited by line feeds in the story text (see OffsetsTextInfo._getLineOffsets),
+# so all paragraph boundaries can be computed with a single pass over the text.
+# Caches are keyed by the tree interceptor and are discarded as soon as the buffer changes.
+
+from array import array
+import bisect
+import config
+import operator
+import re
+import textInfos
+import time
+from virtualBuffers import VirtualBufferTextInfo
+import weakref
+
+LINE_BREAK_RE = re.compile(r"\r\n|[\r\n]")
+# Characters outside of basic multilingual plane take two offsets in virtual buffers, but only one character in Python strings.
+ASTRAL_RE = re.compile("[\U00010000-\U0010FFFF]")
+
+class DocumentIndex:
+    def __init__(self, text, generation):
+        self.generation = generation
+        self.buildTime = time.monotonic()
+        self.text = text
+        # Maps (paragraph index, dominant) to (font size, style) tuple
+        self.formatting = {}
+        # Maps paragraph index to run-length encoded formatting: (run start offsets, format ids) pair of arrays.
+        # Format tuples are interned, so that runs only store small integer ids.
+        self.formatRuns = {}
+        self.formats = []
+        self.formatIds = {}
+        # ControlIndex, built on first request
+        self.controlIndex = None
+        self.storyLength = len(text)
+        strStarts = array('l', [0])
+        strStarts.extend(
+            m.end()
+            for m in LINE_BREAK_RE.finditer(text)
+            if m.end() < len(text)
+        )
+        self.strStarts = strStarts
+        self.astralPositions = [m.start() for m in ASTRAL_RE.finditer(text)]
+        if len(self.astralPositions) == 0:
+            self.starts = strStarts
+        else:
+            self.storyLength += len(self.astralPositions)
+            self.starts = array('l', [self.strToOffset(i) for i in strStarts])
+
+    def strToOffset(self, i):
+        if len(self.astralPositions) == 0:
+            return i
+        return i + bisect.bisect_left(self.astralPositions, i)
+
+    def internFormat(self, format):
+        try:
+            return self.formatIds[format]
+        except KeyError:
+            formatId = len(self.formats)
+            self.formats.append(format)
+            self.formatIds[format] = formatId
+            return formatId
+
+    def __len__(self):
+        return len(self.starts)
+
+    def paragraphIndex(self, offset):
+        return max(0, bisect.bisect_right(self.starts, offset) - 1)
+
+    def paragraphBounds(self, offset):
+        i = self.paragraphIndex(offset)
+        return self.getParagraphBounds(i)
+
+    def getParagraphBounds(self, i):
+        start = self.starts[i]
+        try:
+            end = self.starts[i + 1]
+        except IndexError:
+            end = self.storyLength
+        return start, end
+
+    def getParagraphText(self, i):
+        start = self.strStarts[i]
+        try:
+            end = self.strStarts[i + 1]
+        except IndexError:
+            end = len(self.text)
+        return self.text[start:end]
+
+    def countParagraphs(self, startOffset, endOffset):
+        # Number of paragraphs spanned from paragraph containing startOffset until paragraph containing endOffset inclusive.
+        return abs(self.paragraphIndex(endOffset) - self.paragraphIndex(startOffset)) + 1
+
+class RoleRuns:
+    # Runs of adjacent paragraphs that belong to the same control of a given role.
+    # A control that reappears after a gap, e.g. when uniqueIDs are missing, starts a new run,
+    # so that every run is treated as a separate control and the next different control is always in the next run.
+    def __init__(self):
+        self.firsts = array('l')
+        self.lasts = array('l')
+        self.ids = []
+
+    def add(self, paragraph, uniqueID):
+        if len(self.ids) > 0 and self.ids[-1] == uniqueID and self.lasts[-1] == paragraph - 1:
+            self.lasts[-1] = paragraph
+        else:
+            self.firsts.append(paragraph)
+            self.lasts.append(paragraph)
+            self.ids.append(uniqueID)
+
+    def findNext(self, paragraph, direction):
+        # Returns index of the nearest paragraph in given direction that belongs to a different run, or None.
+        if direction > 0:
+            k = bisect.bisect_right(self.lasts, paragraph)
+            if k < len(self.ids) and self.firsts[k] <= paragraph:
+                # That's the run containing current paragraph
+                k += 1
+            if k >= len(self.ids):
+                return None
+            return self.firsts[k]
+        else:
+            k = bisect.bisect_left(self.firsts, paragraph) - 1
+            if k >= 0 and self.lasts[k] >= paragraph:
+                k -= 1
+            if k < 0:
+                return None
+            return self.lasts[k]
+
+class ControlIndex:
+    """
+    Control fields of the whole document, computed with a single getTextWithFields walk.
+    Every paragraph is attributed the outermost control of each role that contains the beginning of that paragraph,
+    or otherwise the first control of that role that starts within the paragraph.
+    This matches the first controlStart field of that role that getTextWithFields returns for the paragraph.
+    Additionally for every paragraph it stores bitmasks of roles present in that paragraph
+    and of the role of the innermost control at its start, which is what NVDAObjectAtStart would return.
+    """
+    def __init__(self, index, fields):
+        self.roleRuns = {}
+        # Maps role to its bit in role masks
+        self.roleBits = {}
+        self.roleMasks = [0] * len(index)
+        self.startRoleMasks = [0] * len(index)
+        starts = index.starts
+        stack = []
+        offset = 0
+        paragraph = -1
+        paragraphRoles = None
+        def startParagraphs(isBefore):
+            # Starts all paragraphs whose beginning satisfies isBefore(start, offset).
+            nonlocal paragraph, paragraphRoles
+            while paragraph + 1 < len(starts) and isBefore(starts[paragraph + 1], offset):
+                paragraph += 1
+                paragraphRoles = set()
+                for controlField in stack:
+                    self.addControl(paragraph, paragraphRoles, controlField)
+                if len(stack) > 0:
+                    self.setStartRole(paragraph, stack[-1])
+        for field in fields:
+            if isinstance(field, str):
+                startParagraphs(operator.le)
+                offset += getOffsetLength(field)
+                # Paragraphs starting in the middle of this string
+                startParagraphs(operator.lt)
+            elif isinstance(field, textInfos.FieldCommand):
+                if field.command == "controlStart":
+                    startParagraphs(operator.le)
+                    stack.append(field.field)
+                    self.addControl(paragraph, paragraphRoles, field.field)
+                    if offset == starts[paragraph]:
+                        # Controls starting together with the paragraph are nested in the ones already on the stack.
+                        self.setStartRole(paragraph, field.field)
+                elif field.command == "controlEnd" and len(stack) > 0:
+                    # Controls ending right at paragraph boundary don't belong to the next paragraph, so it is not started here.
+                    stack.pop()
+
+    def addControl(self, paragraph, paragraphRoles, controlField):
+        role = controlField.get('role', None)
+        if role is None or role in paragraphRoles:
+            return
+        paragraphRoles.add(role)
+        try:
+            runs = self.roleRuns[role]
+        except KeyError:
+            runs = self.roleRuns[role] = RoleRuns()
+            self.roleBits[role] = 1 << len(self.roleBits)
+        runs.add(paragraph, controlField.get('uniqueID', 0))
+        self.roleMasks[paragraph] |= self.roleBits[role]
+
+    def setStartRole(self, paragraph, controlField):
+        try:
+            self.startRoleMasks[paragraph] = self.roleBits[controlField['role']]
+        except KeyError:
+            self.startRoleMasks[paragraph] = 0
+
+    def getRoleMask(self, roles):
+        mask = 0
+        for role in roles:
+            mask |= self.roleBits.get(role, 0)
+        return mask
+
+    def isRolePresent(self, paragraph, roles):
+        return (self.roleMasks[paragraph] & self.getRoleMask(roles)) != 0
+
+    def findRole(self, paragraph, roles, direction, atStart=False):
+        # Returns index of the nearest paragraph in given direction containing any of the roles, or None.
+        # If atStart is True, only the innermost control at paragraph start is considered.
+        mask = self.getRoleMask(roles)
+        if mask == 0:
+            return None
+        masks = self.startRoleMasks if atStart else self.roleMasks
+        end = len(masks) if direction > 0 else -1
+        for i in range(paragraph + direction, end, direction):
+            if masks[i] & mask:
+                return i
+        return None
+
+    def findNext(self, paragraph, role, direction):
+        try:
+            runs = self.roleRuns[role]
+        except KeyError:
+            return None
+        return runs.findNext(paragraph, direction)
+
+def getOffsetLength(s):
+    # Length of a string in virtual buffer offsets, that is in UTF-16 code units.
+    return len(s) + len(ASTRAL_RE.findall(s))
+
+documentIndexes = weakref.WeakKeyDictionary()
+
+# Generation also includes a few short slices of text sampled across the document,
+# so that most edits that keep the length of the document intact are detected as well.
+GENERATION_SAMPLE_COUNT = 4
+GENERATION_SAMPLE_LENGTH = 32
+def getGeneration(textInfo):
+    """
+    Returns a cheap fingerprint of the document: only its length and a few short slices of text are retrieved out of the buffer.
+    Caches keyed by this fingerprint can still miss a change that keeps the length intact and doesn't touch any of the sampled slices,
+    e.g. a counter updating in the middle of a large page.
+    Such changes only lead to stale results until the next change that is detected.
+    """
+    storyLength = textInfo._getStoryLength()
+    step = max(0, storyLength - GENERATION_SAMPLE_LENGTH) // (GENERATION_SAMPLE_COUNT - 1)
+    if step == 0:
+        # Document is too short to sample
+        samples = (textInfo._getTextRange(0, storyLength),)
+    else:
+        samples = tuple(
+            textInfo._getTextRange(start, start + GENERATION_SAMPLE_LENGTH)
+            for start in range(0, step * GENERATION_SAMPLE_COUNT, step)
+        )
+    return (textInfo.obj.VBufHandle, storyLength, hash(samples))
+
+# Callers that are invoked on every keystroke only rebuild an outdated index this often,
+# so that pages that keep changing are not copied out of the buffer on every key press.
+MIN_REBUILD_INTERVAL = 2 # seconds
+
+def getDocumentIndex(textInfo, rebuild=True, minRebuildInterval=0):
+    """
+    Returns cached DocumentIndex for the document that textInfo belongs to, rebuilding it if the document has changed.
+    If rebuild is False, or the outdated index has been built less than minRebuildInterval seconds ago,
+    returns None instead of rebuilding it.
+    Returns None for documents that are not backed by virtual buffers.
+    """
+    if not isinstance(textInfo, VirtualBufferTextInfo):
+        return None
+    document = textInfo.obj
+    try:
+        generation = getGeneration(textInfo)
+    except Exception:
+        return None
+    index = documentIndexes.get(document)
+    if index is None or index.generation != generation:
+        if not rebuild:
+            return None
+        if index is not None and time.monotonic() - index.buildTime < minRebuildInterval:
+            return None
+        index = DocumentIndex(textInfo._getStoryText(), generation)
+        documentIndexes[document] = index
+    return index
+
+# Maps document to the time when its control index was last built
+controlIndexBuildTimes = weakref.WeakKeyDictionary()
+
+def getControlIndex(index, textInfo, rebuild=True):
+    """
+    Returns ControlIndex of the document, building it on first request.
+    Building it requires fields of the whole document, so in documents that keep changing it is rebuilt at most every MIN_REBUILD_INTERVAL seconds.
+    Returns None if the index is not available, in which case callers should walk the document paragraph by paragraph instead.
+    """
+    if index.controlIndex is None:
+        if not rebuild:
+            return None
+        document = textInfo.obj
+        lastBuildTime = controlIndexBuildTimes.get(document)
+        if lastBuildTime is not None and time.monotonic() - lastBuildTime < MIN_REBUILD_INTERVAL:
+            return None
+        formatConfig=config.conf['documentFormatting']
+        info = document.makeTextInfo(textInfos.POSITION_ALL)
+        index.controlIndex = ControlIndex(index, info.getTextWithFields(formatConfig))
+        controlIndexBuildTimes[document] = time.monotonic()
+    return index.controlIndex
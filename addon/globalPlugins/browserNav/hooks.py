@@ -0,0 +1,72 @@
+#A part of the BrowserNav addon for NVDA
+#Copyright (C) 2017-2021 Tony Malykh
+#This file is covered by the GNU General Public License.
+#See the file LICENSE  for more details.
+
+# BrowserNav wraps a number of NVDA functions that are called on every caret movement or focus event.
+# Each wrapper is only installed while some config option or site rule needs it,
+# so that users who don't use a feature don't pay for it.
+# Call update() every time configuration changes.
+
+from logHandler import log
+
+class Hook:
+    """
+    Monkeypatch that replaces owner.attr with replacement while isNeeded() returns True.
+    Upon installation original function is stored in module.originalName, so that replacement can call it.
+    """
+    def __init__(self, owner, attr, replacement, module, originalName, isNeeded, onChange=None):
+        self.owner = owner
+        self.attr = attr
+        self.replacement = replacement
+        self.module = module
+        self.originalName = originalName
+        self.isNeeded = isNeeded
+        # Called with the function that is now in effect, for functions that also need to be registered elsewhere.
+        self.onChange = onChange
+        self.installed = False
+
+    def set(self, func):
+        setattr(self.owner, self.attr, func)
+        if self.onChange is not None:
+            self.onChange(func)
+
+    def install(self):
+        if self.installed:
+            return
+        setattr(self.module, self.originalName, getattr(self.owner, self.attr))
+        self.set(self.replacement)
+        self.installed = True
+
+    def uninstall(self):
+        if not self.installed:
+            return
+        if getattr(self.owner, self.attr) is not self.replacement:
+            # Somebody else has wrapped our function, so removing it now would also remove their wrapper.
+            return
+        self.set(getattr(self.module, self.originalName))
+        self.installed = False
+
+hooks = []
+
+def registerHook(*args, **kwargs):
+    hook = Hook(*args, **kwargs)
+    hooks.append(hook)
+    return hook
+
+def update(*args, **kwargs):
+    for hook in hooks:
+        try:
+            needed = hook.isNeeded()
+        except Exception:
+            log.exception(f"Failed to evaluate whether {hook.attr} hook is needed")
+            needed = True
+        if needed:
+            hook.install()
+        else:
+            hook.uninstall()
+
+def uninstallAll():
+    for hook in reversed(hooks):
+        hook.uninstall()
+    hooks.clear()
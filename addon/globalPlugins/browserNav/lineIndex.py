@@ -0,0 +1,108 @@
+#A part of the BrowserNav addon for NVDA
+#Copyright (C) 2017-2021 Tony Malykh
+#This file is covered by the GNU General Public License.
+#See the file LICENSE  for more details.
+
+# This module doesn't depend on NVDA or wx, so that it can be tested standalone.
+
+from array import array
+import bisect
+import re
+
+def getCommonPrefixLength(s1, s2):
+    # Binary search over slice comparisons, which are much faster than comparing character by character in Python.
+    low, high = 0, min(len(s1), len(s2))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if s1[low:middle] == s2[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def getCommonSuffixLength(s1, s2, limit):
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if s1[len(s1) - middle:len(s1) - low] == s2[len(s2) - middle:len(s2) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+class LineIndex:
+    """
+    Offsets of line starts in the text of a multiline text control.
+    Allows converting between string offsets and (column, line) without splitting the whole text.
+    Index is marked dirty on every text change and is updated lazily on next access.
+    Text control doesn't tell us which range has been edited, so upon update we find it by comparing old and new text,
+    and only rescan line breaks within the edited range.
+    """
+    def __init__(self, textCtrl):
+        self.textCtrl = textCtrl
+        self.text = None
+        self.starts = None
+        self.dirty = True
+
+    def invalidate(self):
+        self.dirty = True
+
+    def update(self):
+        if not self.dirty:
+            return self.text
+        text = self.textCtrl.GetValue().replace("\r\n", "\n").replace("\r", "\n")
+        if self.text is None:
+            starts = array('l', [0])
+            starts.extend(m.end() for m in re.finditer("\n", text))
+        else:
+            oldText, oldStarts = self.text, self.starts
+            prefix = getCommonPrefixLength(oldText, text)
+            suffix = getCommonSuffixLength(oldText, text, min(len(oldText), len(text)) - prefix)
+            delta = len(text) - len(oldText)
+            # Line starts are offsets right after line breaks: the ones whose line break lies in common prefix are unchanged,
+            # and the ones whose line break lies in common suffix are shifted by delta.
+            starts = oldStarts[:bisect.bisect_right(oldStarts, prefix)]
+            starts.extend(m.end() for m in re.compile("\n").finditer(text, prefix, len(text) - suffix))
+            starts.extend(start + delta for start in oldStarts[bisect.bisect_right(oldStarts, len(oldText) - suffix):])
+        self.text = text
+        self.starts = starts
+        self.dirty = False
+        return self.text
+
+    def getLineCount(self):
+        self.update()
+        return len(self.starts)
+
+    def getLineStart(self, lineNum):
+        self.update()
+        return self.starts[lineNum]
+
+    def getLineEnd(self, lineNum):
+        # Offset of the end of line, excluding line break.
+        self.update()
+        try:
+            return self.starts[lineNum + 1] - 1
+        except IndexError:
+            return len(self.text)
+
+    def getLine(self, lineNum):
+        self.update()
+        return self.text[self.getLineStart(lineNum):self.getLineEnd(lineNum)]
+
+    def offsetToXY(self, offset):
+        self.update()
+        lineNum = bisect.bisect_right(self.starts, offset) - 1
+        return offset - self.starts[lineNum], lineNum
+
+    def xyToOffset(self, columnNum, lineNum):
+        return min(self.getLineStart(lineNum) + columnNum, self.getLineEnd(lineNum))
+
+    # wx positions don't always match string offsets, e.g. line breaks count as two characters in Windows edit controls.
+    # So we always convert through (column, line).
+    def offsetToPosition(self, offset):
+        columnNum, lineNum = self.offsetToXY(offset)
+        return self.textCtrl.XYToPosition(columnNum, lineNum)
+
+    def positionToOffset(self, pos):
+        dummy, columnNum, lineNum = self.textCtrl.PositionToXY(pos)
+        return self.xyToOffset(columnNum, lineNum)
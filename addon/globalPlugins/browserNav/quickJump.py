@@ -10,18 +10,25 @@ from contextlib import ExitStack
 import controlTypes
 from controlTypes import OutputReason
 import copy
+import core
 import dataclasses
 from dataclasses import dataclass
 from enum import Enum
 import functools
 import globalVars
 import gui
+import hashlib
 from gui import guiHelper, nvdaControls
 from gui.settingsDialogs import SettingsPanel
 import json
+from logHandler import log
 import os
+import pickle
 import re
+import shutil
 import textInfos
+import threading
+import time
 import tones
 from typing import List, Tuple
 import ui
@@ -31,8 +38,13 @@ import addonHandler
 addonHandler.initTranslation()
 
 sonifyTextInfo = None # Due to import error we set this value from __init__
+recordJump = None # Same as above
+from . addonConfig import *
 from . beeper import *
+from . import documentIndex
+from . import hooks
 from . import utils
+from . import rulesLayers
 
 
 try:
@@ -409,21 +421,40 @@ class QJSite(QJImmutable):
 class QJConfig(QJImmutable):
     sites: Tuple[QJSite]
 
-    def __init__(self, d):
+    def __init__(self, d=None, sites=None, sharedSites=(), includeDefaults=False, removedSites=(), siteOrder=()):
         super().__init__()
-        self.sites= tuple([
-            QJSite(item)
-            for item in d['sites']
-        ])
+        if sites is None:
+            sites = [
+                QJSite(item)
+                for item in d['sites']
+            ]
+            includeDefaults = d.get('includeDefaults', False)
+            removedSites = d.get('removedSites', ())
+            siteOrder = d.get('siteOrder', ())
+        self.sites= tuple(sites)
+        # Sites that came from default and shared rules layers, as they were loaded. These are not saved to personal rules unless modified.
+        self.sharedSites = tuple(sharedSites)
+        # Personal rules files written before rules were layered contain a full copy of default rules, so default layer is only loaded for newer files.
+        self.includeDefaults = includeDefaults
+        # Only used in personal rules: override keys of default and shared sites that have been deleted, and order of all sites.
+        self.removedSites = tuple(tuple(key) for key in removedSites)
+        self.siteOrder = tuple(tuple(key) for key in siteOrder)
         self.freeze()
 
     def asDict(self):
-        return {
+        result = {
             'sites': [
                 site.asDict()
                 for site in self.sites
             ],
         }
+        if self.includeDefaults:
+            result['includeDefaults'] = True
+        if len(self.removedSites) > 0:
+            result['removedSites'] = [list(key) for key in self.removedSites]
+        if len(self.siteOrder) > 0:
+            result['siteOrder'] = [list(key) for key in self.siteOrder]
+        return result
 
     def __hash__(self):
         return id(self)
@@ -434,7 +465,7 @@ class QJConfig(QJImmutable):
             site.asDict()
             for site in sites
         ]
-        return QJConfig(d)
+        return QJConfig(d, sharedSites=self.sharedSites)
 
 rulesFileName = os.path.join(globalVars.appArgs.configPath, "browserNavRules.json")
 defaultRulesFileName = os.path.join(
@@ -442,27 +473,345 @@ defaultRulesFileName = os.path.join(
     "browserNavRules.json"
 )
 
-def loadConfig():
+# Rules are layered: default rules shipped with the add-on are loaded first,
+# then all *.json files in shared rules directory in alphabetical order, followed by personal rules.
+# Default and shared rules are read-only, e.g. shared rules can be a directory synced with the team.
+# Sites in later layers override sites with the same domain and URL matching mode from earlier layers.
+sharedRulesDirectory = os.path.join(globalVars.appArgs.configPath, "browserNavSharedRules")
+
+# Building QJConfig out of JSON is slow for large rule sets, so we also keep a pickled copy of parsed rules of each layer.
+# JSON files remain the source of truth: the cache is only used when it was built from the same contents of the same file.
+rulesCacheFileName = os.path.join(globalVars.appArgs.configPath, "browserNavRules.cache")
+sharedRulesCacheDirectory = os.path.join(globalVars.appArgs.configPath, "browserNavRulesCache")
+RULES_CACHE_FORMAT_VERSION = 3
+RulesCacheHeader = namedtuple('RulesCacheHeader', ['version', 'addonVersion', 'fileName', 'mtime', 'size', 'digest'])
+
+def getAddonVersion():
+    # Pickled rules are only valid for the same version of the add-on, since classes might have changed.
+    try:
+        return addonHandler.getCodeAddon().version
+    except Exception:
+        return None
+
+def getRulesDigest(rulesConfig):
+    return hashlib.sha1(rulesConfig.encode('utf-8')).hexdigest()
+
+def makeRulesCacheHeader(fileName, digest):
+    st = os.stat(fileName)
+    return RulesCacheHeader(RULES_CACHE_FORMAT_VERSION, getAddonVersion(), fileName, st.st_mtime_ns, st.st_size, digest)
+
+def getRulesCacheFileName(fileName):
+    if fileName == rulesFileName:
+        return rulesCacheFileName
+    name = hashlib.sha1(os.path.normcase(fileName).encode('utf-8')).hexdigest()
+    return os.path.join(sharedRulesCacheDirectory, name + ".cache")
+
+def readRulesCache(cacheFileName):
+    try:
+        with open(cacheFileName, "rb") as f:
+            fields = pickle.load(f)
+            if len(fields) != len(RulesCacheHeader._fields):
+                return None, None
+            header = RulesCacheHeader(*fields)
+            if (header.version, header.addonVersion) != (RULES_CACHE_FORMAT_VERSION, getAddonVersion()):
+                return None, None
+            return header, pickle.load(f)
+    except FileNotFoundError:
+        return None, None
+    except Exception:
+        log.exception("Failed to read BrowserNav rules cache")
+        return None, None
+
+def writeRulesCache(header, config):
+    cacheFileName = getRulesCacheFileName(header.fileName)
+    tempFileName = cacheFileName + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(cacheFileName), exist_ok=True)
+        with open(tempFileName, "wb") as f:
+            pickle.dump(tuple(header), f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(config, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tempFileName, cacheFileName)
+    except Exception:
+        log.exception("Failed to write BrowserNav rules cache")
+
+def loadRulesLayer(fileName):
+    mylog(fileName)
+    header, config = readRulesCache(getRulesCacheFileName(fileName))
+    if header is not None and header.fileName == fileName:
+        st = os.stat(fileName)
+        if (header.mtime, header.size) == (st.st_mtime_ns, st.st_size):
+            return config
+    rulesConfig = open(fileName, "r").read()
+    digest = getRulesDigest(rulesConfig)
+    # If only the timestamp has changed, e.g. file has been touched or copied, then cached rules are still good.
+    if header is None or header.fileName != fileName or header.digest != digest:
+        config = QJConfig(json.loads(rulesConfig))
+    writeRulesCache(makeRulesCacheHeader(fileName, digest), config)
+    return config
+
+def getSharedRulesFileNames():
     try:
-        rulesConfig = open(rulesFileName, "r").read()
-        mylog(rulesFileName)
+        names = sorted(os.listdir(sharedRulesDirectory))
     except FileNotFoundError:
-        rulesConfig = open(defaultRulesFileName, "r").read()
-        mylog(defaultRulesFileName)
-    return QJConfig(json.loads(rulesConfig))
+        return []
+    return [
+        os.path.join(sharedRulesDirectory, name)
+        for name in names
+        if name.lower().endswith(".json")
+    ]
 
+def getSiteOverrideKey(site):
+    # Stored in personal rules, so it must be serializable to JSON.
+    return (site.domain.lower(), site.urlMatch.value)
+
+def mergeRulesLayers(sharedLayers, personalLayer):
+    # Here sharedLayers includes default rules layer, if any.
+    sites = rulesLayers.mergeLayers(
+        [layer.sites for layer in sharedLayers],
+        personalLayer.sites,
+        personalLayer.removedSites,
+        personalLayer.siteOrder,
+        getSiteOverrideKey,
+    )
+    return QJConfig(
+        sites=sites,
+        sharedSites=[
+            site
+            for layer in sharedLayers
+            for site in layer.sites
+        ],
+        includeDefaults=personalLayer.includeDefaults,
+    )
 
-def saveConfig():
-    global globalConfig
-    configDict = globalConfig.asDict()
+def loadConfig():
+    if os.path.exists(rulesFileName):
+        personalLayer = loadRulesLayer(rulesFileName)
+    else:
+        personalLayer = QJConfig(sites=[], includeDefaults=True)
+    sharedLayers = []
+    if personalLayer.includeDefaults:
+        sharedLayers.append(loadRulesLayer(defaultRulesFileName))
+    for sharedFileName in getSharedRulesFileNames():
+        try:
+            sharedLayers.append(loadRulesLayer(sharedFileName))
+        except Exception:
+            # A broken shared file shouldn't prevent personal rules from loading
+            log.exception(f"Failed to load shared BrowserNav rules from {sharedFileName}")
+    if len(sharedLayers) == 0:
+        return personalLayer
+    return mergeRulesLayers(sharedLayers, personalLayer)
+
+def getPersonalLayer(config):
+    # Personal layer consists of all sites, except for sites that came from default or shared layers and haven't been modified,
+    # together with deletions and order of default and shared sites.
+    if len(config.sharedSites) == 0:
+        return config
+    personalSites, removedSites, siteOrder = rulesLayers.splitPersonalLayer(
+        config.sites,
+        config.sharedSites,
+        getSiteOverrideKey,
+        getSiteKey,
+    )
+    return QJConfig(
+        sites=personalSites,
+        includeDefaults=config.includeDefaults,
+        removedSites=removedSites,
+        siteOrder=siteOrder,
+    )
+
+
+RULES_BACKUP_COUNT = 3
+def getRulesBackupFileName(i):
+    return f"{rulesFileName}.bak{i}"
+
+def writeRules(config):
+    # Writes to a temporary file first and then renames it, so that a crash in the middle of writing cannot corrupt the rules.
+    config = getPersonalLayer(config)
+    configDict = config.asDict()
     rulesJson = json.dumps(configDict, indent=4, sort_keys=True)
-    rulesFile = open(rulesFileName, "w")
-    try:
+    tempFileName = rulesFileName + ".tmp"
+    with open(tempFileName, "w") as rulesFile:
         rulesFile.write(rulesJson)
-    finally:
-        rulesFile.close()
+        rulesFile.flush()
+        os.fsync(rulesFile.fileno())
+    if os.path.exists(rulesFileName):
+        for i in range(RULES_BACKUP_COUNT - 1, 0, -1):
+            if os.path.exists(getRulesBackupFileName(i)):
+                os.replace(getRulesBackupFileName(i), getRulesBackupFileName(i + 1))
+        shutil.copy2(rulesFileName, getRulesBackupFileName(1))
+    os.replace(tempFileName, rulesFileName)
+    # So that rules watcher doesn't reload what we've just written
+    global rulesFileStat
+    rulesFileStat = getRulesFileStat()
+    writeRulesCache(makeRulesCacheHeader(rulesFileName, getRulesDigest(rulesJson)), config)
+
+class RulesWriter:
+    """
+    Writes rules on a background thread.
+    A burst of saves within delay seconds results in a single write of the latest config.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.condition = threading.Condition()
+        # Held while writing, so that flush() waits for a write in progress and an older config can never overwrite a newer one.
+        self.writeLock = threading.Lock()
+        self.pending = None
+        self.deadline = 0
+        self.thread = None
+
+    def schedule(self, config):
+        with self.condition:
+            self.pending = config
+            self.deadline = time.monotonic() + self.delay
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                while self.pending is not None:
+                    remaining = self.deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        with self.writeLock:
+            with self.condition:
+                config = self.pending
+                self.pending = None
+            if config is None:
+                return
+            try:
+                writeRules(config)
+            except Exception:
+                log.exception("Failed to save BrowserNav rules")
+
+rulesWriter = RulesWriter(delay=1)
+
+def saveConfig():
+    rulesWriter.schedule(globalConfig)
+    hooks.update()
+
+globalConfig = None
+globalConfigLock = threading.Lock()
+def getGlobalConfig():
+    # Rules are loaded on first use or in background by preloadGlobalConfig(), so that parsing them doesn't slow down NVDA startup.
+    global globalConfig, rulesFileStat
+    if globalConfig is None:
+        with globalConfigLock:
+            if globalConfig is None:
+                rulesFileStat = getRulesFileStat()
+                globalConfig = loadConfig()
+    return globalConfig
+
+# Names, mtimes and sizes of rules files that globalConfig corresponds to
+rulesFileStat = None
+def getRulesFileStat():
+    result = []
+    for fileName in [rulesFileName] + getSharedRulesFileNames():
+        try:
+            st = os.stat(fileName)
+        except FileNotFoundError:
+            continue
+        result.append((fileName, st.st_mtime_ns, st.st_size))
+    return tuple(result)
+
+def getSiteKey(site):
+    return json.dumps(site.asDict(), sort_keys=True)
 
-globalConfig  = loadConfig()
+def reuseUnchangedSites(oldConfig, newConfig):
+    # Keeping the same QJSite objects for unchanged sites keeps lru caches of their matchers warm.
+    oldSites = {
+        getSiteKey(site): site
+        for site in oldConfig.sites
+    }
+    return QJConfig(
+        sites=[
+            oldSites.get(getSiteKey(site), site)
+            for site in newConfig.sites
+        ],
+        sharedSites=newConfig.sharedSites,
+        includeDefaults=newConfig.includeDefaults,
+        removedSites=newConfig.removedSites,
+        siteOrder=newConfig.siteOrder,
+    )
+
+class RulesWatcher:
+    """
+    Polls modification time of rules file and reloads rules when it has been changed outside of BrowserNav.
+    When the file is unchanged each check costs a single os.stat() call.
+    """
+    def __init__(self):
+        self.timer = None
+        self.reloading = False
+
+    def start(self):
+        self.stop()
+        interval = getConfig("rulesReloadInterval")
+        if interval > 0:
+            self.timer = core.callLater(interval * 1000, self.check)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.Stop()
+            self.timer = None
+
+    def check(self):
+        self.timer = None
+        stat = getRulesFileStat()
+        if (
+            not self.reloading
+            and globalConfig is not None
+            and stat != rulesFileStat
+            and rulesWriter.pending is None
+        ):
+            # We're on the main thread, so if the pool is busy we'd rather try again next time than wait.
+            self.reloading = utils.threadPool.try_add_task(self.reload, globalConfig)
+        self.start()
+
+    def reload(self, oldConfig):
+        global rulesFileStat
+        try:
+            stat = getRulesFileStat()
+            try:
+                newConfig = reuseUnchangedSites(oldConfig, loadConfig())
+            except Exception:
+                log.exception("Failed to reload BrowserNav rules")
+                # Don't try again until the file changes once more
+                rulesFileStat = stat
+                return
+            wx.CallAfter(self.swap, oldConfig, newConfig, stat)
+        finally:
+            self.reloading = False
+
+    def swap(self, oldConfig, newConfig, stat):
+        global globalConfig, rulesFileStat
+        if globalConfig is not oldConfig:
+            # Rules have been edited in BrowserNav while we were loading. These edits will be saved over the file anyway.
+            return
+        globalConfig = newConfig
+        rulesFileStat = stat
+        hooks.update()
+
+rulesWatcher = RulesWatcher()
+
+def preloadGlobalConfig():
+    def preload():
+        try:
+            getGlobalConfig()
+        except Exception:
+            log.exception("Failed to load BrowserNav rules")
+            return
+        # Hooks for site-specific features can only be evaluated once rules are loaded.
+        wx.CallAfter(hooks.update)
+    # If the pool is busy, rules will be loaded upon first use instead.
+    utils.threadPool.try_add_task(preload)
 
 
 @functools.lru_cache()
@@ -546,6 +895,14 @@ def getLiveRegionMode(url, config):
     return LiveRegionMode(mode)
 
 
+def anySite(predicate):
+    # Used to decide whether hooks for site-specific features need to be installed at all.
+    # Doesn't wait for rules to load: hooks are updated again once loading is done.
+    config = globalConfig
+    if config is None:
+        return False
+    return any(predicate(site) for site in config.sites)
+
 def getDebugBeepModes(url, config):
     sites = findSites(url, config)
     if len(sites) == 0:
@@ -583,7 +940,7 @@ def getUrl(self):
 
 originalShouldPassThrough = None
 def newShouldPassThrough(self, obj, reason= None):
-    focusMode = getFocusMode(getUrl(self), globalConfig)
+    focusMode = getFocusMode(getUrl(self), getGlobalConfig())
     if reason == OutputReason.FOCUS and focusMode == FocusMode.DONT_ENTER_FORM_MODE:
         return self.passThrough
     else:
@@ -592,9 +949,9 @@ def newShouldPassThrough(self, obj, reason= None):
 original_event_gainFocus = None
 def new_event_gainFocus(self, obj, nextHandler):
     url = getUrl(self)
-    if DebugBeepMode.ON_FOCUS in getDebugBeepModes(url, globalConfig):
+    if DebugBeepMode.ON_FOCUS in getDebugBeepModes(url, getGlobalConfig()):
         tones.beep(500, 50)
-    focusMode = getFocusMode(url, globalConfig)
+    focusMode = getFocusMode(url, getGlobalConfig())
     if focusMode == FocusMode.DISABLE_FOCUS:
         return nextHandler()
     return original_event_gainFocus(self, obj, nextHandler)
@@ -611,18 +968,29 @@ def newReportLiveRegion(text: str, politeness: str):
     except AttributeError:
         pass
     if url is not None:
-        if DebugBeepMode.ON_LIVE_REGION in getDebugBeepModes(url, globalConfig):
+        if DebugBeepMode.ON_LIVE_REGION in getDebugBeepModes(url, getGlobalConfig()):
             tones.beep(500, 50)
-        if LiveRegionMode.MUTE_LIVE_REGION == getLiveRegionMode(url, globalConfig):
+        if LiveRegionMode.MUTE_LIVE_REGION == getLiveRegionMode(url, getGlobalConfig()):
             # Skipping!
             return -1
     return originalReportLiveRegion(text, politeness)
 
+def getDocumentGeneration(self):
+    try:
+        return documentIndex.getGeneration(self.makeTextInfo(textInfos.POSITION_FIRST))
+    except Exception:
+        # Not a virtual buffer, so we cannot tell whether it has changed.
+        return None
+
+# While the page doesn't change, continuous autoClick delay doubles up to this many times autoClickContinuousDelay.
+AUTO_CLICK_MAX_BACKOFF = 32
 asyncAutoclickCounter = 0
 def asyncAutoclick(self, asyncAutoclickCounterLocal, site):
     global asyncAutoclickCounter
     yield site.autoClickOnFocusDelay
     category = site.autoClickCategory
+    lastGeneration = None
+    delay = site.autoClickContinuousDelay
     while True:
         if asyncAutoclickCounter != asyncAutoclickCounterLocal:
             return
@@ -632,15 +1000,22 @@ def asyncAutoclick(self, asyncAutoclickCounterLocal, site):
                 return
         except AttributeError:
             return
-        autoClick(
-            self, 
-            gesture=None, 
-            category=category, 
-            site=site, 
-            automated=True
-        )
+        generation = getDocumentGeneration(self)
+        if generation is None or generation != lastGeneration:
+            autoClick(
+                self, 
+                gesture=None, 
+                category=category, 
+                site=site, 
+                automated=True
+            )
+            lastGeneration = generation
+            delay = site.autoClickContinuousDelay
+        else:
+            # Nothing has changed since last scan
+            delay = min(2 * delay, AUTO_CLICK_MAX_BACKOFF * site.autoClickContinuousDelay)
         if site.autoClickContinuous:
-            yield site.autoClickContinuousDelay
+            yield delay
         else:
             return
 
@@ -648,7 +1023,7 @@ original_event_treeInterceptor_gainFocus = None
 def pre_event_treeInterceptor_gainFocus(self):
     if not self._hadFirstGainFocus:
         url = getUrl(self)
-        sites = findSites(url, globalConfig)
+        sites = findSites(url, getGlobalConfig())
         autoClickSites = [site for site in sites if site.autoClickOnFocus]
         if len(autoClickSites) >= 2:
             ui.message(_("BrowserNav warning: Two or more sites matching this URL are configured to perform autoClick on load. This is not supported."))
@@ -819,7 +1194,7 @@ def moveParagraph(textInfo, offset):
     
     
 def moveParagraphWithSkipClutter(self, textInfo, offset):
-    bookmarks = findApplicableBookmarks(globalConfig, getUrl(self), BookmarkCategory.SKIP_CLUTTER)
+    bookmarks = findApplicableBookmarks(getGlobalConfig(), getUrl(self), BookmarkCategory.SKIP_CLUTTER)
     direction = 1 if offset > 0 else -1
     distance = 0
     while offset != 0:
@@ -836,8 +1211,8 @@ def moveParagraphWithSkipClutter(self, textInfo, offset):
 def quickJump(self, gesture, category, direction, errorMsg):
     oldSelection = self.selection
     url = getUrl(self)
-    bookmarks = findApplicableBookmarks(globalConfig, url, category)
-    skipClutterBookmarks = findApplicableBookmarks(globalConfig, url, BookmarkCategory.SKIP_CLUTTER)
+    bookmarks = findApplicableBookmarks(getGlobalConfig(), url, category)
+    skipClutterBookmarks = findApplicableBookmarks(getGlobalConfig(), url, BookmarkCategory.SKIP_CLUTTER)
     if len(bookmarks) == 0:
         return endOfDocument(_('No quickJump bookmarks configured for current website. Please add QuickJump bookmarks in BrowserNav settings in NVDA settings window.'))
     textInfo = self.makeTextInfo(textInfos.POSITION_CARET)
@@ -869,11 +1244,12 @@ def quickJump(self, gesture, category, direction, errorMsg):
             textInfo.collapse()
             self._set_selection(textInfo)
             self.selection = textInfo
+            recordJump(self, oldSelection, textInfo)
             sonifyTextInfo(self.selection, oldTextInfo=oldSelection, includeCrackle=True)
             return
 
 def caretMovementWithAutoSkip(self, gesture,unit, direction=None,posConstant=textInfos.POSITION_SELECTION, *args, **kwargs):
-    bookmarks = findApplicableBookmarks(globalConfig, getUrl(self), BookmarkCategory.SKIP_CLUTTER)
+    bookmarks = findApplicableBookmarks(getGlobalConfig(), getUrl(self), BookmarkCategory.SKIP_CLUTTER)
     skipped = False
     oldInfo=self.makeTextInfo(posConstant)
     info=oldInfo.copy()
@@ -906,9 +1282,165 @@ def caretMovementWithAutoSkip(self, gesture,unit, direction=None,posConstant=tex
         skippedParagraphChime()
 
 
+class AutoClickIndex:
+    """
+    Indices of paragraphs whose text matches any of given bookmarks.
+    When document changes, only paragraphs that differ from the previous scan are matched again:
+    paragraphs in common prefix and suffix of old and new document keep their candidates.
+    """
+    def __init__(self, bookmarks):
+        self.bookmarks = bookmarks
+        self.generation = None
+        self.texts = []
+        self.candidates = []
+        # IA2UniqueIDs of objects already clicked by automated autoClick
+        self.clickedIDs = set()
+
+    def update(self, index):
+        if index.generation == self.generation:
+            return
+        oldTexts = self.texts
+        texts = [index.getParagraphText(i) for i in range(len(index))]
+        limit = min(len(oldTexts), len(texts))
+        prefix = 0
+        while prefix < limit and oldTexts[prefix] == texts[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and oldTexts[-1 - suffix] == texts[-1 - suffix]:
+            suffix += 1
+        delta = len(texts) - len(oldTexts)
+        self.candidates = (
+            [i for i in self.candidates if i < prefix]
+            + [
+                i
+                for i in range(prefix, len(texts) - suffix)
+                if matchWidthCompositeRegex(self.bookmarks, texts[i]) is not None
+            ]
+            + [i + delta for i in self.candidates if i >= len(oldTexts) - suffix]
+        )
+        self.texts = texts
+        self.generation = index.generation
+
+autoClickIndexes = weakref.WeakKeyDictionary()
+def getAutoClickIndex(self, bookmarks):
+    indexes = autoClickIndexes.setdefault(self, {})
+    try:
+        return indexes[bookmarks]
+    except KeyError:
+        # Bookmarks have changed, so old indexes are no longer needed
+        indexes.clear()
+        result = AutoClickIndex(bookmarks)
+        indexes[bookmarks] = result
+        return result
+
+def iterateAutoClickParagraphs(self, bookmarks, autoClickIndex):
+    # Yields paragraphs that might match bookmarks.
+    index = documentIndex.getDocumentIndex(self.makeTextInfo(textInfos.POSITION_FIRST))
+    if index is not None:
+        autoClickIndex.update(index)
+        for i in autoClickIndex.candidates:
+            textInfo = self.makeTextInfo(textInfos.POSITION_FIRST)
+            textInfo._startOffset, textInfo._endOffset = index.getParagraphBounds(i)
+            yield textInfo
+        return
+    # Not a virtual buffer, so walking all paragraphs
+    textInfo = self.makeTextInfo(textInfos.POSITION_ALL)
+    textInfo.collapse()
+    textInfo.expand(textInfos.UNIT_PARAGRAPH)
+    while True:
+        yield textInfo.copy()
+        result = moveParagraph(textInfo, 1)
+        if result == 0:
+            break
+
+def verifyAutoClickMatch(paragraphInfo, textInfo, focusable, bookmark):
+    # Checks that paragraph containing focusable still matches bookmark.
+    startOffset, endOffset = textInfo._getOffsetsFromNVDAObject(focusable)
+    controlInfo = textInfo.copy()
+    # Cached index is only used if document hasn't changed since we matched paragraphInfo.
+    index = documentIndex.getDocumentIndex(textInfo, rebuild=False)
+    if index is not None:
+        i = index.paragraphIndex(startOffset)
+        if i == index.paragraphIndex(paragraphInfo._startOffset):
+            # That's the paragraph we've just matched
+            return True
+        if len(bookmark.attributes) == 0:
+            return matchWidthCompositeRegex((bookmark,), index.getParagraphText(i)) is not None
+        controlInfo._startOffset, controlInfo._endOffset = index.getParagraphBounds(i)
+    else:
+        controlInfo._startOffset = startOffset
+        controlInfo._endOffset = endOffset
+        controlInfo.collapse()
+        controlInfo.expand(textInfos.UNIT_PARAGRAPH)
+    return len(list(matchTextAndAttributes((bookmark,), controlInfo))) > 0
+
+AUTO_CLICK_ACTION_TIMEOUT = 3 # seconds
+# doAction calls that hang keep holding their worker thread, so clicks run on their own pool rather than the shared one.
+AUTO_CLICK_THREADS = 2
+autoClickThreadPool = None
+def getAutoClickThreadPool():
+    global autoClickThreadPool
+    if autoClickThreadPool is None:
+        autoClickThreadPool = utils.ThreadPool(AUTO_CLICK_THREADS)
+    return autoClickThreadPool
+
+def doActionInBackground(focusable, future):
+    try:
+        focusable.doAction()
+        future.set(True)
+    except Exception as e:
+        future.setException(e)
+
+def clickAsynchronously(focusables, onDone):
+    """
+    Generator function that clicks focusables via a dedicated thread pool, so that slow doAction calls don't block NVDA and each other.
+    Calls onDone with the lists of successfully clicked and timed out objects after all clicks have either completed or timed out.
+    """
+    pool = getAutoClickThreadPool()
+    queue = list(focusables)
+    pending = []
+    clicked = []
+    timedOut = []
+    stalledDeadline = None
+    while len(queue) > 0 or len(pending) > 0:
+        # Thread pool queue is bounded, so we only add tasks while there is space to avoid blocking.
+        while len(queue) > 0:
+            future = utils.Future()
+            if not pool.try_add_task(doActionInBackground, queue[0], future):
+                break
+            pending.append((queue.pop(0), future, time.monotonic() + AUTO_CLICK_ACTION_TIMEOUT))
+            stalledDeadline = None
+        if len(queue) > 0 and len(pending) == 0:
+            # All workers are held by clicks that have timed out earlier.
+            if stalledDeadline is None:
+                stalledDeadline = time.monotonic() + AUTO_CLICK_ACTION_TIMEOUT
+            elif time.monotonic() > stalledDeadline:
+                log.error(f"BrowserNav autoClick threads are busy, skipping {len(queue)} clicks")
+                queue = []
+        stillPending = []
+        for focusable, future, deadline in pending:
+            if future.done():
+                try:
+                    future.get()
+                    clicked.append(focusable)
+                except NotImplementedError:
+                    # Not sure why this is occasionally thrown
+                    pass
+                except Exception:
+                    log.exception("autoClick doAction failed")
+            elif time.monotonic() > deadline:
+                mylog("doAction timed out")
+                timedOut.append(focusable)
+            else:
+                stillPending.append((focusable, future, deadline))
+        pending = stillPending
+        if len(queue) > 0 or len(pending) > 0:
+            yield 10
+    onDone(clicked, timedOut)
+
 def autoClick(self, gesture, category, site=None, automated=False):
     if site is None:
-        bookmarks = findApplicableBookmarks(globalConfig, getUrl(self), category)
+        bookmarks = findApplicableBookmarks(getGlobalConfig(), getUrl(self), category)
     else:
         bookmarks = findApplicableBookmarks(category=category, site=site)
     mylog(f"Autoclick Found {len(bookmarks)} bookmarks")
@@ -918,16 +1450,13 @@ def autoClick(self, gesture, category, site=None, automated=False):
                 category=BookmarkCategoryNames[category],
             )
         )
-    textInfo = self.makeTextInfo(textInfos.POSITION_ALL)
-    textInfo.collapse()
-    textInfo.expand(textInfos.UNIT_PARAGRAPH)
-    distance = 0
+    autoClickIndex = getAutoClickIndex(self, bookmarks)
     message = None
     focusableErrorMsg = None
     focusables = []
-    while True:
+    for textInfo in iterateAutoClickParagraphs(self, bookmarks, autoClickIndex):
         for match in matchTextAndAttributes(bookmarks, textInfo):
-            mylog(f"Autoclick Match {distance} {textInfo.text}")
+            mylog(f"Autoclick Match {textInfo.text}")
             bookmark = match.bookmark
             thisInfo = textInfo.copy()
             if bookmark.offset == 0:
@@ -937,6 +1466,8 @@ def autoClick(self, gesture, category, site=None, automated=False):
             else:
                 moveParagraph(thisInfo, bookmark.offset)
             focusable = thisInfo.focusableNVDAObjectAtStart
+            if automated and getattr(focusable, 'IA2UniqueID', None) in autoClickIndex.clickedIDs:
+                continue
             if focusable.role in {ROLE_DOCUMENT, ROLE_DIALOG}:
                 if focusableErrorMsg is None:
                     mylog("Bookmark points to non-focusable NVDA object, cannot click it.")
@@ -945,55 +1476,52 @@ def autoClick(self, gesture, category, site=None, automated=False):
                 # Double check that NBDAObject is good - to avoid some race condition as often time the document is still updating.
                 # TODO: we need to come up with some algorithm to double-check when offset is not zero.
                 try:
-                    startOffset, endOffset = thisInfo._getOffsetsFromNVDAObject(focusable)
+                    matches = verifyAutoClickMatch(textInfo, thisInfo, focusable, bookmark)
                 except LookupError:
                     mylog("LookupError! skipping this match.")
                     continue
-                controlInfo = thisInfo.copy()
-                controlInfo._startOffset = startOffset
-                controlInfo._endOffset = endOffset
-                controlInfo.collapse()
-                controlInfo.expand(textInfos.UNIT_PARAGRAPH)
-                matches = len(list(matchTextAndAttributes((bookmark,), controlInfo))) > 0
                 if matches:
                     mylog("Verification successful!")
                     focusables.append(focusable)
                     if message is None and len(bookmark.message) > 0:
                         message = bookmark.message
                 else:
-                    mylog("Verification failed:")
-                    mylog(controlInfo.text)
+                    mylog("Verification failed!")
             else:
                 mylog("Verification skipped since offset is non-zero")
                 focusables.append(focusable)
                 if message is None and len(bookmark.message) > 0:
                     message = bookmark.message
-        distance += 1
-        result = moveParagraph(textInfo, 1)
-        if result == 0:
-            break
-    numSuccessfulClicks = 0
-    for focusable in focusables:
-        try:
-            focusable.doAction()
-            numSuccessfulClicks += 1
-        except NotImplementedError as e:
-            # Not sure why this is occasionally thrown
-            pass
-    if numSuccessfulClicks == 0:
+    if len(focusables) == 0:
         if not automated:
             endOfDocument(focusableErrorMsg or _("No bookmarks matched!"))
         return
     if automated:
-        if site is not None and site.debugBeepMode == DebugBeepMode.ON_AUTO_CLICK:
-            tones.beep(500, 50)
-    else:
-        if message is not None:
-            ui.message(message)
+        # Marking objects as clicked right away, so that next scan doesn't click them again while clicks are in progress.
+        dispatchedIDs = {getattr(focusable, 'IA2UniqueID', None) for focusable in focusables} - {None}
+        autoClickIndex.clickedIDs.update(dispatchedIDs)
+    def onDone(clicked, timedOut):
+        if automated:
+            # Failed clicks can be retried on the next scan.
+            # But not the ones that timed out: they might still be hanging and each retry would hold another worker.
+            autoClickIndex.clickedIDs.difference_update(
+                dispatchedIDs - {getattr(focusable, 'IA2UniqueID', None) for focusable in clicked + timedOut}
+            )
+        if len(clicked) == 0:
+            if not automated:
+                endOfDocument(focusableErrorMsg or _("No bookmarks matched!"))
+            return
+        if automated:
+            if site is not None and site.debugBeepMode == DebugBeepMode.ON_AUTO_CLICK:
+                tones.beep(500, 50)
         else:
-            ui.message(_("Clicked {n} objects.").format(
-                n=len(focusables)
-            ))
+            if message is not None:
+                ui.message(message)
+            else:
+                ui.message(_("Clicked {n} objects.").format(
+                    n=len(clicked)
+                ))
+    utils.executeAsynchronously(clickAsynchronously(focusables, onDone))
 
 
 class HierarchicalLevelsInfo:
@@ -1050,7 +1578,7 @@ def scanLevelsThreadFunc(self, config, future):
     
 def scanLevels(self):
     global globalConfig, hierarchicalCache
-    config = globalConfig
+    config = getGlobalConfig()
     future = utils.Future()
     utils.threadPool.add_task(scanLevelsThreadFunc, self, config, future)
     try:
@@ -1064,12 +1592,12 @@ def scanLevels(self):
 def hierarchicalQuickJump(self, gesture, category, direction, level, unbounded, errorMsg):
     oldSelection = self.selection
     url = getUrl(self)
-    bookmarks = findApplicableBookmarks(globalConfig, url, category)
-    skipClutterBookmarks = findApplicableBookmarks(globalConfig, url, BookmarkCategory.SKIP_CLUTTER)
+    bookmarks = findApplicableBookmarks(getGlobalConfig(), url, category)
+    skipClutterBookmarks = findApplicableBookmarks(getGlobalConfig(), url, BookmarkCategory.SKIP_CLUTTER)
     if len(bookmarks) == 0:
         return endOfDocument(_('No hierarchical quickJump bookmarks configured for current website. Please add QuickJump bookmarks in BrowserNav settings in NVDA settings window.'))
     try:
-        levelsInfo = hierarchicalCache[self][globalConfig].get()
+        levelsInfo = hierarchicalCache[self][getGlobalConfig()].get()
         mylog(f"level={level} levelsInfo={levelsInfo.offsets}")
     except KeyError:
         levelsInfo = None
@@ -1125,6 +1653,7 @@ def hierarchicalQuickJump(self, gesture, category, direction, level, unbounded,
                 textInfo.collapse()
                 self._set_selection(textInfo)
                 self.selection = textInfo
+                recordJump(self, oldSelection, textInfo)
                 sonifyTextInfo(self.selection, oldTextInfo=oldSelection, includeCrackle=True)
                 return
             elif offset not in levelsInfo.offsets:
@@ -1148,10 +1677,10 @@ def hierarchicalQuickJump(self, gesture, category, direction, level, unbounded,
 
 def editOrCreateSite(self, site=None, url=None, domain=None):
     global globalConfig
-    config = globalConfig
+    config = getGlobalConfig()
     try:
         index = config.sites.index(site)
-        knownSites = config.sites[:index] + globalConfig.sites[index+1:]
+        knownSites = config.sites[:index] + getGlobalConfig().sites[index+1:]
     except ValueError:
         index = None
         knownSites = config.sites
@@ -1170,7 +1699,7 @@ def editOrCreateSite(self, site=None, url=None, domain=None):
         mylog(f"Config saved!")
 def makeWebsiteSubmenu(self, frame):
     url = getUrl(self)
-    sites = findSites(url, globalConfig)
+    sites = findSites(url, getGlobalConfig())
     menu = wx.Menu()
 
     for site in sites:
@@ -1204,7 +1733,7 @@ def makeWebsiteSubmenu(self, frame):
 
 def editOrCreateBookmark(self, site, bookmark=None, paragraphInfo=None, text=None):
     global globalConfig
-    config = globalConfig
+    config = getGlobalConfig()
     siteIndex = config.sites.index(site)
     if bookmark is not None:
         bookmarkIndex = site.bookmarks.index(bookmark)
@@ -1280,7 +1809,7 @@ def makeBookmarkSubmenu(self, frame):
         )
         return menu
     url = getUrl(self)
-    sites = findSites(url, globalConfig)
+    sites = findSites(url, getGlobalConfig())
     if len(sites) == 0:
         menuStr = _("No sites are configured for current URL.")
         errorMsg = menuStr + "\n" + _("Please create a new site configuration in site submenu.")
@@ -1292,7 +1821,7 @@ def makeBookmarkSubmenu(self, frame):
         )
         return menu
 
-    bookmarks = findApplicableBookmarks(globalConfig, url, category=None)
+    bookmarks = findApplicableBookmarks(getGlobalConfig(), url, category=None)
     matches = matchAllWidthCompositeRegex(bookmarks, text)
     attributes = extractAttributes(paragraphInfo)
 
@@ -1964,7 +2493,7 @@ class SettingsDialog(SettingsPanel):
 
     def makeSettings(self, settingsSizer):
         global globalConfig
-        self.config = copy.deepcopy(globalConfig)
+        self.config = copy.deepcopy(getGlobalConfig())
 
         sHelper = gui.guiHelper.BoxSizerHelper(self, sizer=settingsSizer)
       # Sites table
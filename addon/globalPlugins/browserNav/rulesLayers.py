@@ -0,0 +1,63 @@
+#A part of the BrowserNav addon for NVDA
+#Copyright (C) 2017-2021 Tony Malykh
+#This file is covered by the GNU General Public License.
+#See the file LICENSE  for more details.
+
+# Layering of BrowserNav rules: default and shared rules files are read-only,
+# so everything the user changes about them is stored in personal rules.
+# Sites are opaque here, callers supply key functions.
+# This module doesn't depend on NVDA, so that it can be tested standalone.
+
+def mergeLayers(sharedLayers, personalSites, removedKeys, siteOrder, getOverrideKey):
+    """
+    Sites in later layers override sites with the same override key from earlier layers.
+    Shared sites whose keys are in removedKeys are dropped.
+    Sites mentioned in siteOrder are sorted accordingly, other sites keep their relative order after them.
+    """
+    # Keys might come as lists out of JSON
+    removedKeys = {tuple(key) for key in removedKeys}
+    sites = []
+    for layer in sharedLayers:
+        overridden = {getOverrideKey(site) for site in layer}
+        sites = [
+            site
+            for site in sites
+            if getOverrideKey(site) not in overridden
+        ]
+        sites.extend(
+            site
+            for site in layer
+            if getOverrideKey(site) not in removedKeys
+        )
+    personalKeys = {getOverrideKey(site) for site in personalSites}
+    sites = [
+        site
+        for site in sites
+        if getOverrideKey(site) not in personalKeys
+    ]
+    sites.extend(personalSites)
+    if len(siteOrder) > 0:
+        positions = {tuple(key): i for i, key in enumerate(siteOrder)}
+        sites.sort(key=lambda site: positions.get(getOverrideKey(site), len(positions)))
+    return sites
+
+def splitPersonalLayer(sites, sharedSites, getOverrideKey, getSiteKey):
+    """
+    Computes what needs to be saved in personal rules for the current list of sites.
+    Returns (personalSites, removedKeys, siteOrder): sites that are new or differ from shared ones,
+    override keys of shared sites that have been deleted and override keys of all sites in current order.
+    """
+    sharedSiteKeys = {getSiteKey(site) for site in sharedSites}
+    personalSites = [
+        site
+        for site in sites
+        if getSiteKey(site) not in sharedSiteKeys
+    ]
+    presentKeys = {getOverrideKey(site) for site in sites}
+    removedKeys = []
+    for site in sharedSites:
+        key = getOverrideKey(site)
+        if key not in presentKeys and key not in removedKeys:
+            removedKeys.append(key)
+    siteOrder = [getOverrideKey(site) for site in sites]
+    return personalSites, removedKeys, siteOrder
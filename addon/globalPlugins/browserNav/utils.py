@@ -4,16 +4,21 @@
 #See the file LICENSE  for more details.
 
 from .constants import *
+from .clipboardWatcher import ClipboardWatcher
 import controlTypes
 import core
+from . import documentIndex
 import _ctypes
 import IAccessibleHandler
-from queue import Queue
+from logHandler import log
+from queue import Queue, Full
 import threading
 from threading import Thread
 from threading import Lock, Condition
+import textInfos
 import tones
 import types
+from virtualBuffers import VirtualBufferTextInfo
 from virtualBuffers.gecko_ia2 import Gecko_ia2_TextInfo
 import weakref
 import winUser
@@ -37,7 +42,7 @@ def weakMemoize(func):
 def executeAsynchronously(gen):
     """
     This function executes a generator-function in such a manner, that allows updates from the operating system to be processed during execution.
-    For an example of such generator function, please see GlobalPlugin.script_editJupyter.
+    For an example of such generator function, please see GlobalPlugin.editJupyter.
     Specifically, every time the generator function yilds a positive number,, the rest of the generator function will be executed
     from within wx.CallLater() call.
     If generator function yields a value of 0, then the rest of the generator function
@@ -68,7 +73,7 @@ class Worker(Thread):
                 func(*args, **kargs)
             except Exception as e:
                 # An exception happened in this thread
-                log.error("Error in ThreadPool ", e)
+                log.exception("Error in ThreadPool")
             finally:
                 # Mark this task as done, whether an exception happened or not
                 self.tasks.task_done()
@@ -83,6 +88,13 @@ class ThreadPool:
     def add_task(self, func, *args, **kargs):
         """ Add a task to the queue """
         self.tasks.put((func, args, kargs))
+    def try_add_task(self, func, *args, **kargs):
+        """ Add a task to the queue unless it is full; never blocks. Returns whether the task has been added """
+        try:
+            self.tasks.put_nowait((func, args, kargs))
+            return True
+        except Full:
+            return False
     def map(self, func, args_list):
         """ Add a list of tasks to the queue """
         for args in args_list:
@@ -103,10 +115,11 @@ class Future:
         self.__exc = None
         self.__is_set = False
 
-    def get(self):
+    def get(self, timeout=None):
+        # Raises TimeoutError if value is not set within timeout seconds.
         with self.__condition:
-            while not self.__is_set:
-                self.__condition.wait()
+            if not self.__condition.wait_for(lambda: self.__is_set, timeout):
+                raise TimeoutError("Future has not been set in time")
             if self.__exc is not None:
                 raise self.__exc
             return self.__val
@@ -183,5 +196,105 @@ def getGeckoParagraphIndent(textInfo, documentHolder=None, oneLastAttempt=False)
         return getGeckoParagraphIndent(textInfo, documentHolder, oneLastAttempt=True)
         
         return None
+
+def getObjectIndent(textInfo):
+    try:
+        obj = textInfo.NVDAObjectAtStart
+        return obj.location[0]
+    except:
+        return None
+
+class IndentProvider:
+    """
+    Computes horizontal offsets of paragraphs within a single document.
+    Providers are created per document via getIndentProvider() and can keep state between calls.
+    """
+    def __init__(self, textInfo):
+        pass
+
+    def isValid(self, textInfo):
+        return True
+
+    def getIndent(self, textInfo):
+        return getObjectIndent(textInfo)
+
+class PointIndentProvider(IndentProvider):
+    # Generic provider: many TextInfo implementations, such as UIA, can compute location of text without creating NVDAObjects.
+    def __init__(self, textInfo):
+        self.pointsSupported = True
+
+    def getIndent(self, textInfo):
+        if self.pointsSupported:
+            try:
+                return textInfo.pointAtStart.x
+            except Exception:
+                self.pointsSupported = False
+        return getObjectIndent(textInfo)
+
+class VirtualBufferIndentProvider(IndentProvider):
+    # Memoizes locations by object identity. Field identifiers are retrieved from the buffer directly,
+    # so NVDAObject is only created once for every object, no matter how many paragraphs it contains.
+    def __init__(self, textInfo):
+        self.generation = documentIndex.getGeneration(textInfo)
+        self.locations = {}
+
+    def isValid(self, textInfo):
+        return self.generation == documentIndex.getGeneration(textInfo)
+
+    def getIndent(self, textInfo):
+        try:
+            identifier = textInfo._getFieldIdentifierFromOffset(textInfo._startOffset)
+        except LookupError:
+            return None
+        try:
+            return self.locations[identifier]
+        except KeyError:
+            pass
+        x = getObjectIndent(textInfo)
+        self.locations[identifier] = x
+        return x
+
+class GeckoIndentProvider(VirtualBufferIndentProvider):
+    # Queries locations of all paragraphs via a single IAccessible document, see getGeckoParagraphIndent().
+    def __init__(self, textInfo):
+        super().__init__(textInfo)
+        self.documentHolder = DocumentHolder(getIA2Document(textInfo))
+
+    def getIndent(self, textInfo):
+        return getGeckoParagraphIndent(textInfo, self.documentHolder)
+
+# List of (TextInfo class, provider class); the first matching entry wins.
+indentProviders = []
+def registerIndentProvider(textInfoClass, providerClass):
+    """
+    Registers indent provider for documents of given TextInfo class.
+    Providers registered later take precedence over earlier ones, so more specific classes should be registered last.
+    """
+    indentProviders.insert(0, (textInfoClass, providerClass))
+
+registerIndentProvider(textInfos.TextInfo, PointIndentProvider)
+registerIndentProvider(VirtualBufferTextInfo, VirtualBufferIndentProvider)
+registerIndentProvider(Gecko_ia2_TextInfo, GeckoIndentProvider)
+
+indentProviderCache = weakref.WeakKeyDictionary()
+def getIndentProvider(textInfo):
+    document = textInfo.obj
+    provider = indentProviderCache.get(document)
+    if provider is not None and provider.isValid(textInfo):
+        return provider
+    for textInfoClass, providerClass in indentProviders:
+        if isinstance(textInfo, textInfoClass):
+            provider = providerClass(textInfo)
+            break
+    else:
+        provider = IndentProvider(textInfo)
+    indentProviderCache[document] = provider
+    return provider
+
+def getParagraphIndent(textInfo):
+    try:
+        return getIndentProvider(textInfo).getIndent(textInfo)
+    except Exception:
+        return None
 # For quick finding paragraphs, llok at:
 # VirtualBufferTextInfo._getParagraphOffsets
\ No newline at end of file
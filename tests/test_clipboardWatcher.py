@@ -0,0 +1,38 @@
+# ClipboardWatcher doesn't depend on NVDA, so it is loaded directly from its file without importing the add-on package.
+
+import importlib.util
+import os
+import unittest
+
+path = os.path.join(os.path.dirname(__file__), "..", "addon", "globalPlugins", "browserNav", "clipboardWatcher.py")
+spec = importlib.util.spec_from_file_location("clipboardWatcher", path)
+clipboardWatcher = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(clipboardWatcher)
+
+class SequenceCounter:
+    def __init__(self):
+        self.value = 1
+
+    def __call__(self):
+        return self.value
+
+class ClipboardWatcherTest(unittest.TestCase):
+    def test_hasChanged(self):
+        counter = SequenceCounter()
+        watcher = clipboardWatcher.ClipboardWatcher(counter)
+        self.assertFalse(watcher.hasChanged())
+        counter.value += 1
+        self.assertTrue(watcher.hasChanged())
+        watcher.reset()
+        self.assertFalse(watcher.hasChanged())
+
+    def test_markChanged(self):
+        counter = SequenceCounter()
+        watcher = clipboardWatcher.ClipboardWatcher(counter)
+        watcher.markChanged()
+        self.assertTrue(watcher.hasChanged())
+        watcher.reset()
+        self.assertFalse(watcher.hasChanged())
+
+if __name__ == "__main__":
+    unittest.main()
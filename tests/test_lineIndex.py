@@ -0,0 +1,52 @@
+# LineIndex doesn't depend on NVDA, so it is loaded directly from its file without importing the add-on package.
+
+import importlib.util
+import os
+import random
+import unittest
+
+path = os.path.join(os.path.dirname(__file__), "..", "addon", "globalPlugins", "browserNav", "lineIndex.py")
+spec = importlib.util.spec_from_file_location("lineIndex", path)
+lineIndex = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(lineIndex)
+
+class FakeTextCtrl:
+    def __init__(self, value):
+        self.value = value
+
+    def GetValue(self):
+        return self.value
+
+class LineIndexTest(unittest.TestCase):
+    def test_getLineOnDirtyIndex(self):
+        ctrl = FakeTextCtrl("first\r\nsecond\nthird")
+        index = lineIndex.LineIndex(ctrl)
+        self.assertEqual(index.getLine(1), "second")
+        ctrl.value = "a\nb"
+        index.invalidate()
+        self.assertEqual(index.getLine(1), "b")
+
+    def test_offsetToXY(self):
+        index = lineIndex.LineIndex(FakeTextCtrl("ab\ncd\n"))
+        self.assertEqual(index.offsetToXY(4), (1, 1))
+        self.assertEqual(index.xyToOffset(5, 0), 2)
+        self.assertEqual(index.getLineCount(), 3)
+
+    def test_incrementalUpdate(self):
+        rng = random.Random(0)
+        ctrl = FakeTextCtrl("")
+        index = lineIndex.LineIndex(ctrl)
+        text = ""
+        for i in range(500):
+            start = rng.randint(0, len(text))
+            end = rng.randint(start, min(len(text), start + 5))
+            text = text[:start] + "".join(rng.choice("ab\n") for j in range(rng.randint(0, 5))) + text[end:]
+            ctrl.value = text
+            index.invalidate()
+            index.update()
+            fresh = lineIndex.LineIndex(ctrl)
+            fresh.update()
+            self.assertEqual(list(index.starts), list(fresh.starts))
+
+if __name__ == "__main__":
+    unittest.main()
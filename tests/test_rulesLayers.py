@@ -0,0 +1,79 @@
+# rulesLayers doesn't depend on NVDA, so it is loaded directly from its file without importing the add-on package.
+# Sites are plain dicts here, personal rules go through a JSON round trip the same way they do in the rules file.
+
+import importlib.util
+import json
+import os
+import unittest
+
+path = os.path.join(os.path.dirname(__file__), "..", "addon", "globalPlugins", "browserNav", "rulesLayers.py")
+spec = importlib.util.spec_from_file_location("rulesLayers", path)
+rulesLayers = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rulesLayers)
+
+def getOverrideKey(site):
+    return (site['domain'].lower(), site['urlMatch'])
+
+def getSiteKey(site):
+    return json.dumps(site, sort_keys=True)
+
+def makeSite(domain, name=""):
+    return {'domain': domain, 'urlMatch': 0, 'name': name}
+
+def save(sites, sharedSites):
+    personalSites, removedKeys, siteOrder = rulesLayers.splitPersonalLayer(sites, sharedSites, getOverrideKey, getSiteKey)
+    return json.dumps({'sites': personalSites, 'removedSites': removedKeys, 'siteOrder': siteOrder})
+
+def load(sharedLayers, personalRules):
+    d = json.loads(personalRules)
+    return rulesLayers.mergeLayers(sharedLayers, d['sites'], d['removedSites'], d['siteOrder'], getOverrideKey)
+
+def getDomains(sites):
+    return [site['domain'] for site in sites]
+
+class RulesLayersTest(unittest.TestCase):
+    def setUp(self):
+        self.defaults = [makeSite("a.com"), makeSite("b.com"), makeSite("c.com")]
+        self.shared = [makeSite("b.com", "shared"), makeSite("d.com")]
+
+    def test_deletedDefaultSiteStaysDeleted(self):
+        sites = load([self.defaults], save([], []))
+        self.assertEqual(getDomains(sites), ["a.com", "b.com", "c.com"])
+        sites = [site for site in sites if site['domain'] != "b.com"]
+        personalRules = save(sites, self.defaults)
+        self.assertEqual(json.loads(personalRules)['sites'], [])
+        self.assertEqual(getDomains(load([self.defaults], personalRules)), ["a.com", "c.com"])
+
+    def test_deletedSiteOverriddenBySharedLayer(self):
+        layers = [self.defaults, self.shared]
+        sites = load(layers, save([], []))
+        self.assertEqual(getDomains(sites), ["a.com", "c.com", "b.com", "d.com"])
+        sites = [site for site in sites if site['domain'] != "b.com"]
+        sharedSites = self.defaults + self.shared
+        self.assertEqual(getDomains(load(layers, save(sites, sharedSites))), ["a.com", "c.com", "d.com"])
+
+    def test_personalOrderOfSharedSites(self):
+        sites = load([self.defaults], save([], []))
+        sites.reverse()
+        sites.insert(1, makeSite("e.com"))
+        personalRules = save(sites, self.defaults)
+        self.assertEqual(getDomains(json.loads(personalRules)['sites']), ["e.com"])
+        self.assertEqual(getDomains(load([self.defaults], personalRules)), ["c.com", "e.com", "b.com", "a.com"])
+        # Sites that appear in shared rules later go after sites known to personal rules
+        self.assertEqual(
+            getDomains(load([self.defaults, self.shared], personalRules)),
+            ["c.com", "e.com", "b.com", "a.com", "d.com"],
+        )
+
+    def test_modifiedSharedSiteIsPersonal(self):
+        sites = load([self.defaults], save([], []))
+        sites[0] = makeSite("a.com", "mine")
+        personalRules = save(sites, self.defaults)
+        self.assertEqual(json.loads(personalRules)['sites'], [makeSite("a.com", "mine")])
+        self.assertEqual(json.loads(personalRules)['removedSites'], [])
+        sites = load([self.defaults], personalRules)
+        self.assertEqual(sites[0], makeSite("a.com", "mine"))
+        self.assertEqual(getDomains(sites), ["a.com", "b.com", "c.com"])
+
+if __name__ == '__main__':
+    unittest.main()